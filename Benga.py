@@ -1,9 +1,10 @@
 import click
 import datetime
 import os.path
-import subprocess
 import pandas as pd
-from src.algorithms import databases, profiling, phylogeny, statistics
+from src.algorithms import databases, profiling, phylogeny, references, statistics
+from src.algorithms.store import ProfileStore
+from src.utils import genecalls, nosql
 
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -51,16 +52,50 @@ def stats(input_dir, output_dir, database):
               help="Disable allele extension. [Default: Enable]")
 @click.option('--no-profiles', default=False, is_flag=True,
               help="Disable generating profiles (profile.tsv). [Default: Enable]")
+@click.option('--executor', default="thread", type=click.Choice(["thread", "process"]),
+              help="Run gene calling in a pool of threads or processes. [Default: thread]")
 @click.option('--debug', default=False, is_flag=True,
               help="Print additional information.")
 @click.argument('database', type=str)
 @click.argument('input_dir', type=click.Path(exists=True))
 @click.argument('output_dir', type=click.Path(exists=True))
-def profile(input_dir, output_dir, database, threads, occrrence, not_extend, no_profiles, debug):
+def profile(input_dir, output_dir, database, threads, occrrence, not_extend, no_profiles, executor, debug):
     """Make profiles with fasta files in INPUT_DIR against DATABASE, and then output to OUTPUT_DIR."""
     profiling.profiling(output_dir, input_dir, database, threads=threads, occr_level=occrrence,
                         enable_adding_new_alleles=(not not_extend), generate_profiles=(not no_profiles),
-                        debug=debug)
+                        debug=debug, executor=executor)
+
+
+@main.command("cache", short_help="Inspect and prune gene call cache",
+              context_settings=CONTEXT_SETTINGS)
+@click.option('--max-size', default=None, metavar="<int>", type=int,
+              help="Evict least recently used entries until the cache fits in <int> MB.")
+@click.option('--clear', default=False, is_flag=True,
+              help="Remove all entries.")
+def cache(max_size, clear):
+    """Show the size of the gene call cache, and prune it if requested."""
+    cache_dir = genecalls.cache_dir()
+    if clear:
+        max_size = 0
+    if max_size is not None:
+        removed = genecalls.prune(cache_dir, max_size * 1024 ** 2)
+        click.echo("Removed {} entries.".format(len(removed)))
+    entries = genecalls.entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    click.echo("{}: {} entries, {:.1f} MB".format(cache_dir, len(entries), total / 1024 ** 2))
+
+
+@main.command("track-load", short_help="Load reference profiles for tracking",
+              context_settings=CONTEXT_SETTINGS)
+@click.option('-b', '--batch-size', default=references.INSERT_BATCH, metavar="<int>", type=int,
+              help="Number of genomes inserted at a time. [Default: {}]".format(references.INSERT_BATCH))
+@click.argument('database', type=str)
+@click.argument('input_path', type=click.Path(exists=True))
+def track_load(database, input_path, batch_size):
+    """Load the profiles of a profile.tsv or a directory of profiles in INPUT_PATH into the tracking DATABASE."""
+    track = nosql.get_dbtrack(database)
+    count = references.load_references(track, references.read_profiles(input_path), batch_size)
+    click.echo("Loaded {} genomes into {}.".format(count, database))
 
 
 @main.command("tree", short_help="Plot dendrogram",
@@ -69,19 +104,40 @@ def profile(input_dir, output_dir, database, threads, occrrence, not_extend, no_
 @click.argument('output_dir', type=click.Path(exists=True))
 @click.option('--distance-annotate', default=False, is_flag=True,
               help="Annotating the distances on dendrogram node [Default: Disable]")
-def tree(input_dir, output_dir, distance_annotate):
+@click.option('--low-memory', default=False, is_flag=True,
+              help="Write distances to a memory-mapped file in OUTPUT_DIR for large collections "
+                   "[Default: Disable]")
+@click.option('-p', '--processes', default=1, type=int,
+              help="Number of processes computing distances with --low-memory [Default: 1]")
+@click.option('--mst', default=False, is_flag=True,
+              help="Cluster from a minimum spanning tree without a distance matrix, "
+                   "and output the tree as JSON and GML [Default: Disable]")
+@click.option('--collapse', default=None, type=int,
+              help="Collapse clades within this allele distance into triangles [Default: None]")
+@click.option('--store', default=None, type=str,
+              help="Add the profiles to the named collection and plot the tree of the whole collection, "
+                   "computing only distances to new genomes [Default: None]")
+@click.option('--scheme', default=None, type=str,
+              help="Scheme of the profiles, such as DATABASE:OCCURRENCE, which must match the scheme "
+                   "of the collection given by --store [Default: None]")
+def tree(input_dir, output_dir, distance_annotate, low_memory, processes, mst, collapse, store, scheme):
     """Plot dendrogram with profile.tsv file in INPUT_DIR, and output to OUTPUT_DIR."""
-    profiles = pd.read_csv(os.path.join(input_dir, "profile.tsv"), sep="\t", index_col=0)
-    dendro = phylogeny.Dendrogram()
-    dendro.make_tree(profiles)
+    profiles = pd.read_csv(os.path.join(input_dir, "profile.tsv"), sep="\t", index_col=0,
+                           dtype=str if store else None)
+    if store:
+        profile_store = ProfileStore.open(store)
+        profile_store.add(profiles, scheme)
+        dendro = profile_store.dendrogram()
+    else:
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(profiles, workdir=output_dir if low_memory else None, processes=processes,
+                         method="mst" if mst else "matrix")
     date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
     filename = date + "_tree"
-    dendro.to_newick(os.path.join(output_dir, "{}.newick".format(filename)))
-    dendro.scipy_tree(os.path.join(output_dir, "{}.pdf".format(filename)), distance_annotate)
-    dendro.scipy_tree(os.path.join(output_dir, "{}.svg".format(filename)), distance_annotate)
-    dendro.scipy_tree(os.path.join(output_dir, "{}.png".format(filename)), distance_annotate)
-    subprocess.call(['libreoffice', '--headless', '--convert-to', 'emf', '--outdir', output_dir,
-                     os.path.join(output_dir, "{}.svg".format(filename))])
+    if mst:
+        dendro.mst_to_json(os.path.join(output_dir, "{}.mst.json".format(filename)))
+        dendro.mst_to_gml(os.path.join(output_dir, "{}.mst.gml".format(filename)))
+    dendro.export(os.path.join(output_dir, filename), distance_annotate=distance_annotate, collapse=collapse)
 
 
 if __name__ == "__main__":
@@ -107,11 +107,27 @@ DATABASES = {
     }
 }
 
+# Connection pool of the SQLAlchemy engines used by src.utils.db
+SQLALCHEMY_POOL = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_recycle': 3600,
+    'pool_pre_ping': True,
+}
+
 
+# MongoDB of the tracking references, CLIENT may name a stand-in such as mongomock.MongoClient
 NOSQLS = {
     'mongodb': {
         'HOST': 'localhost',
-        'PORT': 5432
+        'PORT': 27017,
+        'CLIENT': 'pymongo.MongoClient',
+        'OPTIONS': {
+            'maxPoolSize': 50,
+            'readPreference': 'primaryPreferred',
+            'serverSelectionTimeoutMS': 5000,
+            'connectTimeoutMS': 5000,
+        },
     }
 }
 
@@ -158,3 +174,20 @@ STATIC_URL = '/static/'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Local caches shared by profiling runs and workers
+CACHE_ROOT = os.environ.get('BENGA_CACHE_ROOT', os.path.join(BASE_DIR, 'cache'))
+
+# Upper bound of the gene call cache in bytes, least recently used entries are evicted first
+GENE_CALL_CACHE_SIZE = 10 * 1024 ** 3
+
+# Tasks each Celery worker runs at once, as given to celery worker -c
+WORKER_CONCURRENCY = int(os.environ.get('BENGA_WORKER_CONCURRENCY', os.cpu_count() or 1))
+
+# Dendrograms of more genomes than this compute distances into a memory-mapped file with a thread pool,
+# sharing the cores among the tasks of a worker
+DENDROGRAM_MMAP_GENOMES = 5000
+DENDROGRAM_THREADS = max(1, (os.cpu_count() or 1) // WORKER_CONCURRENCY)
+
+# Tracking results kept by each worker, least recently used entries are evicted first
+TRACKING_CACHE_ENTRIES = 1024
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from dendrogram.models import Profile, Dendrogram
+from src.algorithms.store import COLLECTION_PATTERN
 
 
 class ProfileSerializer(serializers.ModelSerializer):
@@ -15,6 +16,8 @@ class DendrogramSerializer(serializers.ModelSerializer):
 
 
 class PlotingSerializer(serializers.ModelSerializer):
+    collection = serializers.RegexField(COLLECTION_PATTERN, required=False, write_only=True)
+
     class Meta:
         model = Dendrogram
-        fields = ('id', )
+        fields = ('id', 'collection')
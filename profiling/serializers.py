@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from profiling.models import Batch, Sequence, Profile
+from src.algorithms.store import COLLECTION_PATTERN
 
 
 class BatchSerializer(serializers.ModelSerializer):
@@ -21,6 +22,8 @@ class ProfileSerializer(serializers.ModelSerializer):
 
 
 class ProfilingSerializer(serializers.ModelSerializer):
+    collection = serializers.RegexField(COLLECTION_PATTERN, required=False, write_only=True)
+
     class Meta:
         model = Profile
-        fields = ('id', 'occurrence', 'database')
+        fields = ('id', 'occurrence', 'database', 'collection')
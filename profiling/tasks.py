@@ -10,7 +10,7 @@ from django.core.files import File
 
 from profiling.serializers import ProfileSerializer
 from src.algorithms import profiling
-from src.utils import files
+from src.utils import files, db
 import dendrogram.tasks as tree
 
 
@@ -64,7 +64,7 @@ def do_profiling(batch_id, database, occr_level):
 
 
 @shared_task
-def profile_and_tree(batch_id, database, occr_level):
+def profile_and_tree(batch_id, database, occr_level, collection=None):
     input_dir = os.path.join(settings.MEDIA_ROOT, "uploads", batch_id)
     output_dir = os.path.join(settings.MEDIA_ROOT, "temp", batch_id)
     files.create_if_not_exist(output_dir)
@@ -74,7 +74,15 @@ def profile_and_tree(batch_id, database, occr_level):
     save(batch_id, database, occr_level, profile_filename, zip_filename)
 
     # plot dendrogram
-    emf_filename, newick_filename, pdf_filename, png_filename, svg_filename = tree.plot(output_dir, output_dir)
+    scheme = "{}:{}".format(database, occr_level)
+    emf_filename, newick_filename, pdf_filename, png_filename, svg_filename = tree.plot(output_dir, output_dir,
+                                                                                      collection, scheme)
     tree.save(batch_id, emf_filename, newick_filename, pdf_filename, png_filename, svg_filename)
 
     shutil.rmtree(output_dir)
+
+
+@shared_task
+def pool_stats():
+    """Hits, misses and checkout time of the database connection pools of the worker running this task."""
+    return db.pool_stats()
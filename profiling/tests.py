@@ -21,3 +21,23 @@ class UploadbatchTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data.keys(), {"id", "created"},
                          "Recieved object does not contain 'id' and 'created' field.")
+
+
+class ProfilingTreeTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.client = None
+
+    def test_invalid_collection(self):
+        """
+        Ensure a collection name which is not a slug is rejected.
+        """
+        batch_id = self.client.post(reverse("upload-list"), {}, format='json').data["id"]
+        url = reverse("profiling-tree")
+        for collection in ["../../tmp", "/etc/benga"]:
+            data = {"id": batch_id, "occurrence": 95, "database": "Vibrio_cholerae", "collection": collection}
+            response = self.client.post(url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("collection", response.data)
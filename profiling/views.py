@@ -104,6 +104,6 @@ class ProfilingTree(APIView):
         serializer = ProfilingSerializer(data=request.data)
         if serializer.is_valid():
             profile_and_tree.delay(str(serializer.data["id"]), serializer.data["database"],
-                                   serializer.data["occurrence"])
+                                   serializer.data["occurrence"], serializer.validated_data.get("collection"))
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
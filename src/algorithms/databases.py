@@ -8,7 +8,7 @@ from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from Bio import SeqIO
 
-from src.utils import seq, files, cmds, operations, db, logs
+from src.utils import seq, files, cmds, operations, db, logs, index
 from src.utils.alleles import filter_duplicates
 
 
@@ -67,7 +67,7 @@ def filter_rRNA(matrix):
     return matrix[~matrix["is_rrna"]].drop("is_rrna", axis=1)
 
 
-def extract_profiles(roary_matrix_file, dbname, metadata_cols=13):
+def extract_profiles(roary_matrix_file, session, metadata_cols=13):
     matrix = pd.read_csv(roary_matrix_file, low_memory=False)
     matrix["Gene"] = matrix["Gene"].str.replace("/", "_")
     matrix["Gene"] = matrix["Gene"].str.replace(" ", "_")
@@ -77,20 +77,20 @@ def extract_profiles(roary_matrix_file, dbname, metadata_cols=13):
     matrix.set_index("locus_id", inplace=True)
     matrix = filter_tRNA(matrix)
     matrix = filter_rRNA(matrix)
-    save_locus_metadata(matrix, dbname)
+    save_locus_metadata(matrix, session)
     profiles = matrix.iloc[:, metadata_cols:]
     isolates = len(matrix.columns) - metadata_cols
     return profiles, isolates
 
 
-def save_locus_metadata(matrix, dbname, select_col=None, repeat_tol=1.2):
+def save_locus_metadata(matrix, session, select_col=None, repeat_tol=1.2):
     if not select_col:
         select_col = ["locus_id", "num_isolates", "num_sequences", "description", "is_paralog"]
     avg = "Avg sequences per isolate"
     meta = matrix.copy()
     meta["is_paralog"] = [x > repeat_tol for x in meta[avg]]
     meta = meta.reset_index()[select_col]
-    db.table_to_sql("locus_meta", meta, dbname)
+    session.table_to_sql("locus_meta", meta)
 
 
 def collect_allele_info(profiles, ffn_dir):
@@ -149,8 +149,8 @@ def select_drop_loci(df):
     return set(drop1) | set(drop2)
 
 
-def collect_high_occurrence_loci(pairs, total_isolates, drop_by_occur):
-    occur = db.from_sql("select locus_id, num_isolates from locus_meta;")
+def collect_high_occurrence_loci(pairs, total_isolates, drop_by_occur, session):
+    occur = session.from_sql("select locus_id, num_isolates from locus_meta;")
     occur["occurrence"] = list(map(lambda x: round(x / total_isolates * 100, 2), occur["num_isolates"]))
     drops = set()
     for id1, id2 in pairs:
@@ -162,26 +162,26 @@ def collect_high_occurrence_loci(pairs, total_isolates, drop_by_occur):
     return filtered_loci
 
 
-def filter_locus(blastp_out_file, ref_length, total_isolates, drop_by_occur):
+def filter_locus(blastp_out_file, ref_length, total_isolates, drop_by_occur, session):
     blastp_out = filter_duplicates(blastp_out_file, ref_length, ref_length, identity=95)
     pairs = identify_pairs(blastp_out)
-    filtered_loci = collect_high_occurrence_loci(pairs, total_isolates, drop_by_occur)
+    filtered_loci = collect_high_occurrence_loci(pairs, total_isolates, drop_by_occur, session)
     return filtered_loci
 
 
-def to_allele_table(data, dbname):
+def to_allele_table(data, session):
     df = pd.DataFrame(data, columns=["allele_id", "dna_seq", "peptide_seq", "count"])
     df = df.groupby("allele_id").agg({"dna_seq": "first", "peptide_seq": "first", "count": "sum"})
     df.reset_index(inplace=True)
-    db.table_to_sql("alleles", df, dbname)
+    session.table_to_sql("alleles", df)
 
 
-def to_pair_table(data, dbname):
+def to_pair_table(data, session):
     df = pd.DataFrame(data, columns=["allele_id", "locus_id"])
-    db.table_to_sql("pairs", df, dbname)
+    session.table_to_sql("pairs", df)
 
 
-def save_sequences(freq, refseqs, dbname):
+def save_sequences(freq, refseqs, session):
     alleles = []
     pairs = []
     for locus, counter in freq.items():
@@ -192,17 +192,17 @@ def save_sequences(freq, refseqs, dbname):
         allele_id = operations.make_seqid(dna_seq)
         alleles.append((allele_id, dna_seq, pept_seq, count))
         pairs.append((allele_id, locus))
-    to_allele_table(alleles, dbname)
-    to_pair_table(pairs, dbname)
+    to_allele_table(alleles, session)
+    to_pair_table(pairs, session)
 
 
-def make_schemes(refseqs, total_isolates):
-    schemes = db.from_sql("select locus_id, num_isolates from locus_meta;")
+def make_schemes(refseqs, total_isolates, session):
+    schemes = session.from_sql("select locus_id, num_isolates from locus_meta;")
     schemes = schemes[schemes["locus_id"].isin(refseqs.keys())]
     schemes["occurrence"] = list(map(lambda x: round(x/total_isolates * 100, 2), schemes["num_isolates"]))
     schemes["ref_allele"] = list(map(lambda x: refseqs[x], schemes["locus_id"]))
     schemes = schemes[["locus_id", "occurrence", "ref_allele"]]
-    db.table_to_sql("loci", schemes)
+    session.table_to_sql("loci", schemes)
 
 
 def annotate_configs(input_dir, output_dir, logger=None, threads=8):
@@ -260,10 +260,12 @@ def make_database(output_dir, drop_by_occur, logger=None, threads=2):
     dbname = os.path.basename(output_dir[:-1] if output_dir.endswith("/") else output_dir)
     db.createdb(dbname)
     db.create_pgadb_relations(dbname)
+    index.invalidate(dbname)
+    session = db.Session(dbname)
 
     logger.info("Extract profiles from roary result matrix...")
     matrix_file = files.joinpath(output_dir, "roary", "gene_presence_absence.csv")
-    profiles, total_isolates = extract_profiles(matrix_file, dbname)
+    profiles, total_isolates = extract_profiles(matrix_file, session)
 
     logger.info("Collecting allele profiles and making allele frequencies and reference sequence...")
     ffn_dir = files.joinpath(output_dir, "FFN")
@@ -274,7 +276,7 @@ def make_database(output_dir, drop_by_occur, logger=None, threads=2):
     blastp_out_file, ref_length = reference_self_blastp(output_dir, freq)
 
     logger.info("Filter out high identity loci and drop loci which occurrence less than {}...".format(drop_by_occur))
-    filtered_loci = filter_locus(blastp_out_file, ref_length, total_isolates, drop_by_occur)
+    filtered_loci = filter_locus(blastp_out_file, ref_length, total_isolates, drop_by_occur, session)
     os.remove(blastp_out_file)
 
     logger.info("Updating and saving profiles...")
@@ -284,10 +286,10 @@ def make_database(output_dir, drop_by_occur, logger=None, threads=2):
 
     logger.info("Saving allele sequences...")
     refseqs = {locus: counter.most_common(1)[0][0] for locus, counter in freq.items()}
-    save_sequences(freq, refseqs, dbname)
+    save_sequences(freq, refseqs, session)
 
     logger.info("Making dynamic schemes...")
     refseqs = dict(map(lambda x: (x[0], operations.make_seqid(x[1])), refseqs.items()))
-    make_schemes(refseqs, total_isolates)
+    make_schemes(refseqs, total_isolates, session)
     logger.info("Done!!")
     return dbname
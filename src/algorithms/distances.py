@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+MISSING = 0
+BLOCK_ELEMENTS = 2 ** 24
+BLOCK_ROWS = 16
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+
+def code_dtype(n):
+    return np.uint16 if n < np.iinfo(np.uint16).max else np.uint32
+
+
+def distance_dtype(n_loci):
+    return np.uint16 if n_loci <= np.iinfo(np.uint16).max else np.uint32
+
+
+def encode_profiles(profiles):
+    """
+    Encode a locus x genome profile table as a genome x locus matrix of small integers.
+    Alleles are numbered from 1 within each locus and missing alleles are coded as 0.
+    """
+    values = profiles.fillna("0").values
+    codes = np.empty((values.shape[1], values.shape[0]), dtype=code_dtype(values.shape[1] + 1))
+    for i, alleles in enumerate(values):
+        labels, uniques = pd.factorize(alleles)
+        labels += 1
+        labels[alleles == "0"] = MISSING
+        codes[:, i] = labels
+    return codes
+
+
+def condensed_index(n, i):
+    """Position of the pair (i, i + 1) in a condensed distance matrix of n observations."""
+    return n * i - i * (i + 1) // 2
+
+
+def fill_condensed(codes, distances, start, stop):
+    """Write the distances of rows start to stop against all later rows into a condensed matrix."""
+    n, n_loci = codes.shape
+    columns = max(BLOCK_ROWS, BLOCK_ELEMENTS // (BLOCK_ROWS * max(1, n_loci)))
+    for row in range(start, stop, BLOCK_ROWS):
+        row_end = min(stop, row + BLOCK_ROWS)
+        for column in range(row, n, columns):
+            column_end = min(n, column + columns)
+            block = np.count_nonzero(codes[row:row_end, None, :] != codes[None, column:column_end, :], axis=2)
+            for i in range(row, row_end):
+                first = max(column, i + 1)
+                if first < column_end:
+                    begin = condensed_index(n, i) + first - i - 1
+                    distances[begin:begin + column_end - first] = block[i - row, first - column:]
+
+
+def condensed_distances(codes):
+    """Pairwise Hamming distances between the rows of codes as a condensed distance matrix."""
+    n, n_loci = codes.shape
+    distances = np.empty(n * (n - 1) // 2, dtype=distance_dtype(n_loci))
+    fill_condensed(codes, distances, 0, n)
+    return distances
+
+
+def cross_distances(a, b):
+    """Hamming distances between the rows of a and the rows of b as a len(a) x len(b) matrix."""
+    columns = max(1, BLOCK_ELEMENTS // (max(1, len(a)) * max(1, a.shape[1])))
+    block = np.empty((len(a), len(b)), dtype=distance_dtype(a.shape[1]))
+    for start in range(0, len(b), columns):
+        block[:, start:start + columns] = np.count_nonzero(a[:, None, :] != b[None, start:start + columns, :], axis=2)
+    return block
+
+
+def lower_index(j):
+    """Position of the pair (0, j) in a matrix of the distances of each observation to the previous ones."""
+    return j * (j - 1) // 2
+
+
+def lower_row(distances, n, v):
+    """Distances from observation v to all observations, read from a lower triangular matrix."""
+    row = np.zeros(n, dtype=distances.dtype)
+    begin = lower_index(v)
+    row[:v] = distances[begin:begin + v]
+    after = np.arange(v + 1, n)
+    row[v + 1:] = distances[lower_index(after) + v]
+    return row
+
+
+def row_bands(n, bands):
+    """Split rows into bands holding about the same number of pairs."""
+    total = condensed_index(n, n)
+    bounds = [0]
+    for i in range(1, n):
+        if len(bounds) < bands and condensed_index(n, i) >= total * len(bounds) / bands:
+            bounds.append(i)
+    bounds.append(n)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fill_band(args):
+    codes_file, distances_file, start, stop = args
+    codes = np.load(codes_file, mmap_mode="r")
+    distances = np.load(distances_file, mmap_mode="r+")
+    fill_condensed(codes, distances, start, stop)
+    distances.flush()
+
+
+def condensed_distances_mmap(codes, filename, processes=2, executor="process"):
+    """
+    Pairwise Hamming distances written to a memory-mapped condensed matrix in filename.
+    Bands of rows are computed in a pool of processes or threads, each writing its own part of the file.
+    Daemonic processes, such as Celery prefork workers, cannot have children and always use threads.
+    """
+    if multiprocessing.current_process().daemon:
+        executor = "thread"
+    n, n_loci = codes.shape
+    codes_file = filename + ".codes.npy"
+    np.save(codes_file, codes)
+    distances = np.lib.format.open_memmap(filename, mode="w+", dtype=distance_dtype(n_loci),
+                                          shape=(n * (n - 1) // 2,))
+    del distances
+    args = [(codes_file, filename, start, stop) for start, stop in row_bands(n, processes * 4)]
+    with EXECUTORS[executor](processes) as pool:
+        list(pool.map(fill_band, args))
+    os.remove(codes_file)
+    return np.load(filename, mmap_mode="r")
+
+
+def condensed_row(distances, n, v):
+    """Distances from observation v to all observations, read from a condensed matrix."""
+    row = np.zeros(n, dtype=distances.dtype)
+    before = np.arange(v)
+    row[:v] = distances[condensed_index(n, before) + v - before - 1]
+    begin = condensed_index(n, v)
+    row[v + 1:] = distances[begin:begin + n - v - 1]
+    return row
+
+
+def code_rows(codes, v, rows):
+    """Distances from row v of codes to the given rows, compared in bounded chunks."""
+    chunk = max(1, BLOCK_ELEMENTS // (BLOCK_ROWS * max(1, codes.shape[1])))
+    row = np.empty(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), chunk):
+        row[start:start + chunk] = np.count_nonzero(codes[rows[start:start + chunk]] != codes[v], axis=1)
+    return row
+
+
+def prim_mst(n, row_distances):
+    """
+    Minimum spanning tree by Prim's algorithm as a list of (i, j, distance) edges.
+    row_distances(v, rows) gives the distances from v to rows not yet in the tree,
+    so only one row is held at a time.
+    """
+    remaining = np.arange(1, n)
+    best = np.full(n - 1, np.inf)
+    parent = np.zeros(n - 1, dtype=np.int64)
+    edges = []
+    v = 0
+    for last in range(n - 2, -1, -1):
+        row = row_distances(v, remaining)
+        closer = row < best
+        best[closer] = row[closer]
+        parent[closer] = v
+        k = int(np.argmin(best))
+        v = int(remaining[k])
+        edges.append((int(parent[k]), v, float(best[k])))
+        # move the last remaining observation into the free slot
+        remaining[k], best[k], parent[k] = remaining[last], best[last], parent[last]
+        remaining, best, parent = remaining[:last], best[:last], parent[:last]
+    return edges
+
+
+def mst_linkage(edges, n):
+    """SciPy linkage matrix of the single linkage clustering given by a minimum spanning tree."""
+    root = np.arange(n)
+    cluster = np.arange(n)
+    size = np.ones(2 * n - 1, dtype=np.int64)
+
+    def find(x):
+        while root[x] != x:
+            root[x] = root[root[x]]
+            x = root[x]
+        return x
+
+    linkage = np.zeros((n - 1, 4))
+    for k, (i, j, dist) in enumerate(sorted(edges, key=lambda x: x[2])):
+        ri, rj = find(i), find(j)
+        a, b = sorted((cluster[ri], cluster[rj]))
+        size[n + k] = size[a] + size[b]
+        linkage[k] = [a, b, dist, size[n + k]]
+        root[rj] = ri
+        cluster[ri] = n + k
+    return linkage
+
+
+def condensed_mst(distances, n):
+    """Minimum spanning tree of a condensed matrix, which may be memory-mapped, without copying it."""
+    return prim_mst(n, lambda v, rows: condensed_row(distances, n, v)[rows])
+
+
+def single_linkage(distances, n):
+    return mst_linkage(condensed_mst(distances, n), n)
+
+
+def profile_mst(codes):
+    """Minimum spanning tree of encoded profiles, computing one row of distances at a time."""
+    return prim_mst(len(codes), lambda v, rows: code_rows(codes, v, rows))
@@ -1,3 +1,8 @@
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import fastcluster
 import pandas as pd
 from ete3 import Tree
@@ -6,8 +11,20 @@ from scipy.spatial.distance import squareform
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from collections import Counter
+from matplotlib.collections import LineCollection, PolyCollection
 from matplotlib.ticker import MaxNLocator
+from src.algorithms import distances
+from src.utils import emf, svg
+
+FIGURE_FORMATS = ("pdf", "svg", "png")
+EXPORT_FORMATS = ("newick",) + FIGURE_FORMATS + ("emf",)
+LINK_COLOR = "#808080"
+CLADE_COLOR = "#d9d9d9"
+LARGE_TREE_LEAVES = 1000
+SCREEN_DPI = 96
+MAX_RASTER_PIXELS = 10 ** 8
+MAX_RASTER_SIDE = 2 ** 15
+MIN_LABEL_PIXELS = 6
 
 
 class Dendrogram:
@@ -17,88 +34,328 @@ class Dendrogram:
         self._tree = tree
         self._newick = None
         self._ete_tree = None
+        self._newick_file = None
         self._linkage = None
+        self._codes = None
+        self._mst = None
 
     @property
     def newick(self):
         if not self._newick:
-            self._newick = make_newick(self._tree, "", self._tree.dist, self._nodes)
+            buffer = io.StringIO()
+            write_newick(self._tree, buffer, self._nodes)
+            self._newick = buffer.getvalue()
         return self._newick
 
+    @property
+    def mst(self):
+        """Minimum spanning tree of the profiles as (i, j, distance) edges between nodes."""
+        if self._mst is None:
+            self._mst = distances.profile_mst(self._codes)
+        return self._mst
+
     @property
     def ete_tree(self):
         if not self._ete_tree:
-            self._ete_tree = Tree(self.newick)
+            self._ete_tree = Tree(self._newick_file or self.newick)
         return self._ete_tree
 
     def render_on(self, file, w=900, h=1200, units="px", dpi=300, *args):
         self.ete_tree.render(file, w=w, h=h, units=units, dpi=dpi, *args)
 
-    def scipy_tree(self, file, distance_annotate=True, w=8, dpi=300):
+    def figure(self, distance_annotate=True, w=8):
+        """Draw the dendrogram, returning the figure and the layout computed by scipy."""
         plt.style.use("ggplot")
         fig, ax = plt.subplots(1, 1, figsize=(w, int(len(self._nodes)*0.3)))
         ax.grid(False)
         ax.patch.set_facecolor('none')
         ax.xaxis.set_major_locator(MaxNLocator(integer=True))
         plt.rcParams['svg.fonttype'] = 'none'
-        tree = hierarchy.dendrogram(self._linkage, labels=self._nodes, orientation="left",
-                                    leaf_font_size=10, above_threshold_color="#808080", color_threshold=0)
+        tree = hierarchy.dendrogram(self._linkage, labels=self._nodes, orientation="left", ax=ax,
+                                    leaf_font_size=10, above_threshold_color=LINK_COLOR, color_threshold=0)
         if distance_annotate:
             for i, d, in zip(tree['icoord'], tree['dcoord']):
                 x = 0.5 * sum(i[1:3])
                 y = d[1]
-                plt.annotate(int(y), (y, x), xytext=(-2, 8), textcoords='offset points',
-                             va='top', ha='right', fontsize=8)
+                ax.annotate(int(y), (y, x), xytext=(-2, 8), textcoords='offset points',
+                            va='top', ha='right', fontsize=8)
+        return fig, tree
+
+    def scipy_tree(self, file, distance_annotate=True, w=8, dpi=300):
+        fig, _ = self.figure(distance_annotate, w)
         fig.savefig(file, dpi=dpi, bbox_inches='tight', pad_inches=1)
+        plt.close(fig)
 
-    def make_tree(self, profiles):
+    def export(self, prefix, formats=EXPORT_FORMATS, distance_annotate=True, w=8, dpi=300, collapse=None,
+               max_pixels=MAX_RASTER_PIXELS):
+        """
+        Write the dendrogram to prefix.<format> for each of formats and return the filenames.
+        The layout is computed once and figure formats are saved from the same figure,
+        while newick and EMF are written by other threads.
+        Trees with more than LARGE_TREE_LEAVES leaves, or with clades collapsed within the collapse
+        distance, are drawn from a lighter layout: SVG is streamed and PNG is capped to max_pixels.
+        """
+        unknown = set(formats) - set(EXPORT_FORMATS)
+        if unknown:
+            raise ValueError("Unknown formats {}.".format(", ".join(sorted(unknown))))
+        filenames = {x: "{}.{}".format(prefix, x) for x in formats}
+        large = collapse is not None or len(self._nodes) > LARGE_TREE_LEAVES
+        with ThreadPoolExecutor(3) as executor:
+            futures = []
+            if "newick" in filenames:
+                futures.append(executor.submit(self.to_newick, filenames["newick"]))
+            fig = None
+            if large:
+                layout = collapsed_layout(self._tree, self._nodes, collapse)
+                if "svg" in filenames:
+                    futures.append(executor.submit(write_svg, layout, filenames.pop("svg"), distance_annotate))
+                if any(x in filenames for x in FIGURE_FORMATS):
+                    fig = large_figure(layout, distance_annotate)
+            elif any(x in filenames for x in FIGURE_FORMATS):
+                fig, layout = self.figure(distance_annotate, w)
+            else:
+                layout = hierarchy.dendrogram(self._linkage, labels=self._nodes, orientation="left", no_plot=True)
+            if "emf" in filenames:
+                futures.append(executor.submit(write_emf, layout, filenames["emf"], distance_annotate))
+            for x in FIGURE_FORMATS:
+                if x in filenames:
+                    if large:
+                        save_large_figure(fig, filenames[x], dpi, max_pixels)
+                    else:
+                        fig.savefig(filenames[x], dpi=dpi, bbox_inches='tight', pad_inches=1)
+            if fig:
+                plt.close(fig)
+            for future in futures:
+                future.result()
+        return {x: "{}.{}".format(prefix, x) for x in formats}
+
+    def make_tree(self, profiles, workdir=None, processes=1, method="matrix", executor="process"):
+        """
+        Single linkage tree of profiles. With workdir, distances are computed by a pool of processes
+        or threads into a memory-mapped file which is removed once the tree is built. With method "mst",
+        the tree is built from a minimum spanning tree without any distance matrix.
+        """
+        if method not in ("matrix", "mst"):
+            raise ValueError("Unknown method {}.".format(method))
         self._nodes = list(profiles.columns)
-        distances = distance_matrix(profiles)
-        self._linkage = fastcluster.single(squareform(distances))
+        self._codes = distances.encode_profiles(profiles)
+        self._mst = None
+        self._newick = self._newick_file = self._ete_tree = None
+        if method == "mst":
+            self._linkage = distances.mst_linkage(self.mst, len(self._nodes))
+        elif workdir:
+            filename = os.path.join(workdir, "distances.{}.npy".format(os.getpid()))
+            condensed = distances.condensed_distances_mmap(self._codes, filename, processes, executor)
+            self._mst = distances.condensed_mst(condensed, len(self._nodes))
+            self._linkage = distances.mst_linkage(self._mst, len(self._nodes))
+            del condensed
+            os.remove(filename)
+        else:
+            self._linkage = fastcluster.single(distances.condensed_distances(self._codes))
         self._tree = hierarchy.to_tree(self._linkage, False)
 
-    def to_newick(self, file):
+    def load_mst(self, nodes, mst):
+        """Single linkage tree of nodes from the (i, j, distance) edges of their minimum spanning tree."""
+        self._nodes = list(nodes)
+        self._codes = None
+        self._mst = list(mst)
+        self._newick = self._newick_file = self._ete_tree = None
+        self._linkage = distances.mst_linkage(self._mst, len(self._nodes))
+        self._tree = hierarchy.to_tree(self._linkage, False)
+
+    def to_newick(self, file, precision=2):
+        with open(file, "w") as handle:
+            write_newick(self._tree, handle, self._nodes, precision)
+        self._newick_file = file
+
+    def mst_to_json(self, file):
+        """Write the minimum spanning tree as nodes and links, as GrapeTree and d3 read them."""
+        data = {"nodes": [{"id": name} for name in self._nodes],
+                "links": [{"source": self._nodes[i], "target": self._nodes[j], "distance": int(d)}
+                          for i, j, d in self.mst]}
+        with open(file, "w") as file:
+            json.dump(data, file, indent=2)
+
+    def mst_to_gml(self, file):
         with open(file, "w") as file:
-            file.write(self.newick)
+            file.write("graph [\n  directed 0\n")
+            for i, name in enumerate(self._nodes):
+                file.write('  node [\n    id {}\n    label "{}"\n  ]\n'.format(i, str(name).replace('"', "&quot;")))
+            for i, j, d in self.mst:
+                file.write("  edge [\n    source {}\n    target {}\n    weight {}\n  ]\n".format(i, j, int(d)))
+            file.write("]\n")
 
 
 def hamming(xs, ys):
     return sum(xs.ne(ys) & ~(xs.isnull() & ys.isnull()))
 
 
-def distance(array_1, array_2, name_1, name_2):
-    genome_diff = Counter(array_1 == array_2)[False]
-    return name_1, name_2, genome_diff
+def distance_matrix(profile):
+    condensed = distances.condensed_distances(distances.encode_profiles(profile))
+    return pd.DataFrame(squareform(condensed), index=profile.columns, columns=profile.columns)
 
 
-def distance_matrix(profile):
-    profile = profile.fillna('0')
-    profile = profile.transpose()
-    profile_array = profile.values
-    profile_index = [i for i in range(len(profile.index))]
-    pairs = []
-    for i in range(len(profile_index)):
-        index_1 = profile_index.pop(0)
-        pairs.append((profile.index[index_1], profile.index[index_1], 0))
-        for index_2 in profile_index:
-            dist = distance(profile_array[index_1], profile_array[index_2], profile.index[index_1], profile.index[index_2])
-            pairs.append(dist)
-    distances = pd.DataFrame()
-    for pair in pairs:
-        distances.loc[pair[0], pair[1]] = distances.loc[pair[1], pair[0]] = pair[2]
-    return distances
-
-
-def make_newick(node, newick, parentdist, leaf_names):
-    if node.is_leaf():
-        return "{}:{:.2f}{}".format(leaf_names[node.id], parentdist - node.dist, newick)
-    else:
-        if len(newick) > 0:
-            newick = "):{:.2f}{}".format(parentdist - node.dist, newick)
+def write_newick(tree, file, leaf_names, precision=2):
+    """
+    Write a scipy tree in Newick format to a file-like object without recursion.
+    Branch lengths are written with precision decimals and the right child comes first.
+    """
+    length = ":{{:.{}f}}".format(precision)
+    if tree.is_leaf():
+        file.write(str(leaf_names[tree.id]) + length.format(0))
+        return
+    file.write("(")
+    stack = [");", (tree.get_left(), tree.dist), ",", (tree.get_right(), tree.dist)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            file.write(item)
+            continue
+        node, parentdist = item
+        if node.is_leaf():
+            file.write(str(leaf_names[node.id]) + length.format(parentdist - node.dist))
+        else:
+            file.write("(")
+            stack += [")" + length.format(parentdist - node.dist),
+                      (node.get_left(), node.dist), ",", (node.get_right(), node.dist)]
+
+
+def collapsed_layout(tree, leaf_names, threshold=None):
+    """
+    Layout of a scipy tree in the form of scipy's dendrogram, computed without recursion.
+    Clades joined within threshold are drawn as triangles and listed in "triangles"
+    as (coordinate, distance, number of leaves).
+    """
+    layout = {"icoord": [], "dcoord": [], "ivl": [], "triangles": []}
+    positions = {}
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node.is_leaf() or (threshold is not None and node.dist <= threshold):
+            coord = 10 * len(layout["ivl"]) + 5
+            if node.is_leaf():
+                layout["ivl"].append(str(leaf_names[node.id]))
+            else:
+                layout["ivl"].append("{} genomes".format(node.count))
+                layout["triangles"].append((coord, node.dist, node.count))
+            positions[node.id] = (coord, node.dist)
+        elif not visited:
+            stack += [(node, True), (node.get_right(), False), (node.get_left(), False)]
         else:
-            newick = ");"
-        newick = make_newick(node.get_left(), newick, node.dist, leaf_names)
-        newick = make_newick(node.get_right(), ",{}".format(newick), node.dist, leaf_names)
-        newick = "({}".format(newick)
-        return newick
+            (left, left_dist), (right, right_dist) = positions.pop(node.get_left().id), positions.pop(node.get_right().id)
+            layout["icoord"].append([left, left, right, right])
+            layout["dcoord"].append([left_dist, node.dist, node.dist, right_dist])
+            positions[node.id] = ((left + right) / 2, node.dist)
+    return layout
+
+
+class Frame:
+    """Pixel coordinates of a dendrogram layout with the root on the left and leaf labels on the right."""
+
+    ROW_HEIGHT = 16
+
+    def __init__(self, layout, row_height=ROW_HEIGHT, tree_width=600, font_size=11, margin=20):
+        self.n = len(layout["ivl"])
+        self.max_dist = max([max(d) for d in layout["dcoord"]] + [d for _, d, _ in layout.get("triangles", [])])
+        self.row_height = row_height
+        self.tree_width = tree_width
+        self.font_size = font_size
+        self.margin = margin
+        label_width = max(len(x) for x in layout["ivl"]) * font_size * 0.6
+        self.width = 2 * margin + tree_width + 5 + label_width
+        self.height = 2 * margin + self.n * row_height
+
+    def x(self, dist):
+        if not self.max_dist:
+            return self.margin + self.tree_width
+        return self.margin + self.tree_width * (1 - dist / self.max_dist)
+
+    def y(self, coord):
+        # leaf k is at 10k + 5 counting from the bottom
+        return self.margin + (self.n - coord / 10) * self.row_height
+
+
+def drawing(layout, frame, distance_annotate=True):
+    """Links, collapsed clades, leaf labels and distance annotations of a layout in pixels, y pointing down."""
+    links = [[(frame.x(d), frame.y(i)) for i, d in zip(icoord, dcoord)]
+             for icoord, dcoord in zip(layout["icoord"], layout["dcoord"])]
+    triangles = [[(frame.x(dist), frame.y(coord)), (frame.x(0), frame.y(coord - 4)), (frame.x(0), frame.y(coord + 4))]
+                 for coord, dist, _ in layout.get("triangles", [])]
+    labels = [(frame.x(0) + 5, frame.y(10 * k + 5) + frame.font_size / 3, str(label))
+              for k, label in enumerate(layout["ivl"])]
+    annotations = []
+    if distance_annotate:
+        annotations = [(frame.x(dcoord[1]) - 2, frame.y(0.5 * sum(icoord[1:3])) - 3, str(int(dcoord[1])))
+                       for icoord, dcoord in zip(layout["icoord"], layout["dcoord"])]
+    return links, triangles, labels, annotations
+
+
+def write_emf(layout, file, distance_annotate=True):
+    frame = Frame(layout)
+    links, triangles, labels, annotations = drawing(layout, frame, distance_annotate)
+    metafile = emf.Metafile(frame.width, frame.height)
+    metafile.select(metafile.create_pen(LINK_COLOR))
+    metafile.polylines(links + [triangle + triangle[:1] for triangle in triangles])
+    metafile.select(metafile.create_font(frame.font_size))
+    metafile.text_align(emf.TA_LEFT | emf.TA_BASELINE)
+    for x, y, label in labels:
+        metafile.text(x, y, label)
+    if annotations:
+        metafile.select(metafile.create_font(frame.font_size - 3))
+        metafile.text_align(emf.TA_RIGHT | emf.TA_BASELINE)
+        for x, y, label in annotations:
+            metafile.text(x, y, label)
+    metafile.save(file)
+
+
+def write_svg(layout, file, distance_annotate=True):
+    frame = Frame(layout)
+    links, triangles, labels, annotations = drawing(layout, frame, distance_annotate)
+    with svg.SVGWriter(file, frame.width, frame.height) as writer:
+        with writer.group(stroke=LINK_COLOR, fill="none"):
+            for link in links:
+                writer.polyline(link)
+        with writer.group(stroke=LINK_COLOR, fill=CLADE_COLOR):
+            for triangle in triangles:
+                writer.polygon(triangle)
+        with writer.group(font_family="Arial", font_size=frame.font_size):
+            for x, y, label in labels:
+                writer.text(x, y, label)
+        with writer.group(font_family="Arial", font_size=frame.font_size - 3, text_anchor="end"):
+            for x, y, label in annotations:
+                writer.text(x, y, label)
+
+
+def large_figure(layout, distance_annotate=True):
+    """Figure of a layout drawn with collections rather than a matplotlib artist per link."""
+    frame = Frame(layout)
+    links, triangles, labels, annotations = drawing(layout, frame, distance_annotate)
+    fig = plt.figure(figsize=(frame.width / SCREEN_DPI, frame.height / SCREEN_DPI))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(0, frame.width)
+    ax.set_ylim(frame.height, 0)
+    ax.axis("off")
+    ax.add_collection(LineCollection(links, colors=LINK_COLOR, linewidths=0.75))
+    ax.add_collection(PolyCollection(triangles, facecolors=CLADE_COLOR, edgecolors=LINK_COLOR, linewidths=0.75))
+    points = 72 / SCREEN_DPI
+    for x, y, label in labels:
+        ax.text(x, y, label, fontsize=frame.font_size * points, va="baseline")
+    for x, y, label in annotations:
+        ax.text(x, y, label, fontsize=(frame.font_size - 3) * points, va="baseline", ha="right")
+    return fig
+
+
+def raster_dpi(fig, dpi, max_pixels):
+    """Highest dpi up to dpi at which the figure has at most max_pixels pixels and fits the rasterizer."""
+    w, h = fig.get_size_inches()
+    return min(dpi, (max_pixels / (w * h)) ** 0.5, MAX_RASTER_SIDE / max(w, h))
+
 
+def save_large_figure(fig, file, dpi, max_pixels):
+    if file.endswith(".png"):
+        dpi = raster_dpi(fig, dpi, max_pixels)
+    # labels too small to be read are left out of raster images, where drawing them dominates
+    readable = not file.endswith(".png") or Frame.ROW_HEIGHT * dpi / SCREEN_DPI >= MIN_LABEL_PIXELS
+    for text in fig.axes[0].texts:
+        text.set_visible(readable)
+    fig.savefig(file, dpi=dpi)
@@ -1,19 +1,25 @@
-import functools
+import json
 import os
 import re
 import shutil
 import subprocess
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import pandas as pd
-from Bio import SeqIO
+from Bio.Seq import translate
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from django.conf import settings
 
 from src.algorithms.bionumerics import to_bionumerics_format
-from src.utils import files, cmds, operations, logs, seq
-from src.utils.db import load_database_config, from_sql, table_to_sql, to_sql
+from src.utils import files, cmds, operations, logs, seq, index, genecalls
+from src.utils.db import load_database_config, pool_stats, Session
 from src.utils.alleles import filter_duplicates
 
+REF_BLASTPDB_VERSION = 1
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+MIN_SHARD_SIZE = 500
+
 MLST = ["aroC_1", "aroC_2", "aroC_3", "dnaN", "hemD", "hisD", "purE", "sucA_1", "sucA_2", "thrA_2", "thrA_3"]
 virulence_genes = ["lpfA", "lpfA_1", "lpfA_2", "lpfA_3", "lpfA_4", "lpfB", "lpfB_1", "lpfB_2", "lpfC", "lpfC_1",
                    "lpfD", "lpfD_1", "lpfD_2", "lpfE", # "lpfC''", "lpfC''_1", "lpfC''_2", "lpfC'_3",
@@ -46,48 +52,59 @@ virulence_genes = ["lpfA", "lpfA_1", "lpfA_2", "lpfA_3", "lpfA_4", "lpfB", "lpfB
 
 
 def identify_alleles(args):
-    filename, out_dir, model = args
-    subprocess.run(cmds.form_prodigal_cmd(filename, out_dir, model), shell=True)
+    """Call genes of a genome and return its alleles as {allele_id: (dna_seq, peptide_seq, peptide_id)}."""
+    filename, out_dir, model, cache_dir = args
     genome_id = files.fasta_filename(filename)
+    if cache_dir:
+        key = genecalls.contig_key(filename, model)
+        alleles = genecalls.get(cache_dir, key)
+        if alleles is not None:
+            return genome_id, alleles
+
+    # a failed run may leave a partial output, which must not be read or cached
+    subprocess.run(cmds.form_prodigal_cmd(filename, out_dir, model), shell=True, check=True)
     target_file = os.path.join(out_dir, genome_id + ".locus.fna")
-    alleles = {operations.make_seqid(rec.seq): (rec.seq, rec.seq.translate(table=11))
-               for rec in SeqIO.parse(target_file, "fasta")}
+    alleles = {}
+    with open(target_file, "r") as file:
+        for _, dna in SimpleFastaParser(file):
+            peptide = translate(dna, table=11)
+            alleles[operations.make_seqid(dna)] = (dna, peptide, operations.make_seqid(peptide))
+    if cache_dir:
+        genecalls.put(cache_dir, key, alleles)
     return genome_id, alleles
 
 
-def update_allele_counts(counter, database):
-    table_to_sql("batch_add_counts", counter, database=database, append=False)
+def update_allele_counts(counter, session):
     query = "update alleles " \
             "set count = alleles.count + ba.count " \
-            "from batch_add_counts as ba " \
+            "from {staging} as ba " \
             "where alleles.allele_id=ba.allele_id;"
-    to_sql(query, database=database)
-    to_sql("drop table batch_add_counts;", database=database)
+    session.copy_merge([("alleles", counter, query)])
 
 
-def profile_by_query(alleles, genome_id, selected_loci, database):
-    locus_ids = ",".join("'{}'".format(x) for x in selected_loci)
-    allele_ids = ",".join("'{}'".format(x) for x in alleles.keys())
-    query = "select allele_id, locus_id " \
-            "from pairs " \
-            "where allele_id in ({}) and locus_id in ({});".format(allele_ids, locus_ids)
+def profile_by_batch(id_allele_list, selected_loci, allele_index):
+    genome_alleles = pd.DataFrame([(genome_id, allele_id) for genome_id, alleles in id_allele_list
+                                   for allele_id in alleles.keys()], columns=["genome_id", "allele_id"])
+    pairs = allele_index.pairs(genome_alleles["allele_id"].unique())
+    pairs = pairs[pairs["locus_id"].isin(selected_loci)]
     # ensure allele_id is mapped only once
-    profile = from_sql(query, database=database).drop_duplicates("allele_id")
-    # ensure locus_id exists only once
-    profile = profile.drop_duplicates("locus_id").set_index("locus_id")
-    profile = profile.rename(columns={"allele_id": genome_id}).iloc[:, 0]
-    return profile
+    pairs = pairs.drop_duplicates("allele_id")
+    # ensure locus_id exists only once in each genome, keeping the first allele in database order
+    profiles = genome_alleles.merge(pairs, on="allele_id").sort_values("allele_id", kind="stable")
+    profiles = profiles.drop_duplicates(["genome_id", "locus_id"])
+    profiles = profiles.pivot(index="locus_id", columns="genome_id", values="allele_id").rename_axis(columns=None)
+    return profiles.reindex(columns=[genome_id for genome_id, _ in id_allele_list])
 
 
 def generate_allele_len(recs):
     return {rec.id: len(rec.seq) for rec in recs}
 
 
-def make_ref_blastpdb(ref_db_file, database):
+def make_ref_blastpdb(ref_db_file, session):
     query = "select loci.locus_id, alleles.peptide_seq " \
             "from loci inner join alleles " \
             "on loci.ref_allele = alleles.allele_id;"
-    refs = from_sql(query, database=database)
+    refs = session.from_sql(query)
 
     ref_recs = [seq.new_record(row["locus_id"], row["peptide_seq"], seqtype="protein") for _, row in refs.iterrows()]
     ref_fasta = ref_db_file + ".fasta"
@@ -99,15 +116,85 @@ def make_ref_blastpdb(ref_db_file, database):
     return ref_len
 
 
-def blast_for_new_alleles(candidates, alleles, ref_db, temp_dir, ref_len):
+def is_ref_blastpdb(ref_dir):
+    """Whether a cached directory holds a complete reference blastp database and its allele lengths."""
+    if not os.path.exists(files.joinpath(ref_dir, "ref_len.json")):
+        return False
+    return any(x.startswith("ref_blastpdb.") and x.endswith((".pin", ".pal")) for x in os.listdir(ref_dir))
+
+
+def prune_ref_blastpdb(cache_dir, digest):
+    """Remove the databases of other digests, leaving databases being built."""
+    for name in os.listdir(cache_dir):
+        if name != digest and "." not in name:
+            shutil.rmtree(files.joinpath(cache_dir, name), ignore_errors=True)
+
+
+def cached_ref_blastpdb(session):
+    """
+    Reference blastp database of the allele database, shared read-only between jobs.
+    It is rebuilt only when the reference alleles of loci change, and the databases of previous
+    reference alleles are removed then.
+    """
+    refs = session.from_sql("select locus_id, ref_allele from loci order by locus_id;")
+    content = "\n".join("{}\t{}".format(x, y) for x, y in zip(refs["locus_id"], refs["ref_allele"]))
+    digest = operations.make_seqid("{}\n{}".format(REF_BLASTPDB_VERSION, content))
+    cache_dir = files.joinpath(settings.CACHE_ROOT, "ref_blastpdb", session.database)
+    ref_dir = files.joinpath(cache_dir, digest)
+    if os.path.exists(ref_dir) and not is_ref_blastpdb(ref_dir):
+        # left by a failed build before makeblastdb errors were checked
+        shutil.rmtree(ref_dir, ignore_errors=True)
+    if not os.path.exists(ref_dir):
+        build_dir = files.joinpath(cache_dir, "{}.{}".format(digest, operations.create_uuid()))
+        files.create_if_not_exist(build_dir)
+        try:
+            ref_len = make_ref_blastpdb(files.joinpath(build_dir, "ref_blastpdb"), session)
+            with open(files.joinpath(build_dir, "ref_len.json"), "w") as file:
+                file.write(json.dumps(ref_len))
+            if not is_ref_blastpdb(build_dir):
+                raise RuntimeError("makeblastdb wrote no database in {}".format(build_dir))
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        try:
+            os.rename(build_dir, ref_dir)
+        except OSError:  # built by a concurrent job in the meantime
+            shutil.rmtree(build_dir)
+        prune_ref_blastpdb(cache_dir, digest)
+    with open(files.joinpath(ref_dir, "ref_len.json"), "r") as file:
+        ref_len = json.loads(file.read())
+    return files.joinpath(ref_dir, "ref_blastpdb"), ref_len
+
+
+def blast_shard(args):
+    candidate_file, ref_db, blastp_out_file, threads = args
+    seq.query_blastpdb(candidate_file, ref_db, blastp_out_file, seq.BLAST_COLUMNS, threads=threads)
+    return blastp_out_file
+
+
+def blast_for_new_alleles(candidates, alleles, ref_db, temp_dir, ref_len, threads=2):
     filename = "new_allele_candidates"
-    candidate_file = os.path.join(temp_dir, filename + ".fasta")
     recs = [seq.new_record(cand, alleles[cand][1], seqtype="protein") for cand in candidates]
-    seq.save_records(recs, candidate_file)
     allele_len = generate_allele_len(recs)
 
+    # contiguous shards keep the order of hits as in a single blastp run
+    shards = max(1, min(threads, len(recs) // MIN_SHARD_SIZE))
+    shard_size = -(-len(recs) // shards)
+    args = []
+    for i in range(shards):
+        candidate_file = os.path.join(temp_dir, "{}.{}.fasta".format(filename, i))
+        seq.save_records(recs[i * shard_size:(i + 1) * shard_size], candidate_file)
+        shard_out_file = files.joinpath(temp_dir, "{}.{}.blastp.out".format(filename, i))
+        shard_threads = max(1, threads // shards + (1 if i < threads % shards else 0))
+        args.append((candidate_file, ref_db, shard_out_file, shard_threads))
+    with ThreadPoolExecutor(shards) as executor:
+        shard_out_files = list(executor.map(blast_shard, args))
+
     blastp_out_file = files.joinpath(temp_dir, "{}.blastp.out".format(filename))
-    seq.query_blastpdb(candidate_file, ref_db, blastp_out_file, seq.BLAST_COLUMNS)
+    with open(blastp_out_file, "w") as out:
+        for shard_out_file in shard_out_files:
+            with open(shard_out_file, "r") as file:
+                shutil.copyfileobj(file, out)
 
     blastp_out = filter_duplicates(blastp_out_file, allele_len, ref_len, identity=95)
     blastp_out = blastp_out.drop_duplicates("qseqid")
@@ -115,7 +202,7 @@ def blast_for_new_alleles(candidates, alleles, ref_db, temp_dir, ref_len):
     return new_allele_pairs
 
 
-def update_database(new_allele_pairs, alleles):
+def update_database(new_allele_pairs, alleles, session):
     collect = []
     for allele_id, locus_id in new_allele_pairs:
         dna = str(alleles[allele_id][0])
@@ -123,29 +210,59 @@ def update_database(new_allele_pairs, alleles):
         count = 0
         collect.append((allele_id, dna, peptide, count))
     collect = pd.DataFrame(collect, columns=["allele_id", "dna_seq", "peptide_seq", "count"]).drop_duplicates()
-    table_to_sql("alleles", collect)
     pairs = pd.DataFrame(new_allele_pairs, columns=["allele_id", "locus_id"]).drop_duplicates()
-    table_to_sql("pairs", pairs)
+    insert_alleles = "insert into alleles (allele_id, dna_seq, peptide_seq, count) " \
+                     "select allele_id, dna_seq, peptide_seq, count from {staging} " \
+                     "on conflict (allele_id) do nothing;"
+    insert_pairs = "insert into pairs (allele_id, locus_id) " \
+                   "select allele_id, locus_id from {staging} " \
+                   "on conflict (allele_id, locus_id) do nothing;"
+    session.copy_merge([("alleles", collect, insert_alleles), ("pairs", pairs, insert_pairs)])
+    peptides = index.peptide_pairs([str(alleles[x][1]) for x in pairs["allele_id"]], pairs["locus_id"])
+    index.add_pairs(session, pairs, peptides)
     return pairs
 
 
-def add_new_alleles(id_allele_list, ref_db, temp_dir, ref_len):
-    all_alleles = functools.reduce(lambda x, y: {**x, **y[1]}, id_allele_list, {})
-    existed_alleles = from_sql("select allele_id from alleles;")["allele_id"].tolist()
-    candidates = list(filter(lambda x: x not in existed_alleles, all_alleles.keys()))
-    new_allele_pairs = blast_for_new_alleles(candidates, all_alleles, ref_db, temp_dir, ref_len)
+def unknown_alleles(allele_ids, session, allele_index):
+    # alleles paired in the index are known, only the rest is checked against the database
+    allele_ids = [x for x, known in zip(allele_ids, allele_index.contains(allele_ids)) if not known]
+    query = "select allele_id from alleles where allele_id = any(%(allele_ids)s);"
+    existed_alleles = set(session.from_sql(query, params={"allele_ids": allele_ids})["allele_id"])
+    return [x for x in allele_ids if x not in existed_alleles]
+
+
+def assign_by_peptide(candidates, alleles, allele_index):
+    peptide_ids = [alleles[cand][2] for cand in candidates]
+    loci = allele_index.peptide_loci(peptide_ids)
+    return [(cand, locus) for cand, locus in zip(candidates, loci) if locus is not None]
+
+
+def add_new_alleles(id_allele_list, ref_db, temp_dir, ref_len, session, allele_index, threads=2):
+    all_alleles = {}
+    for _, alleles in id_allele_list:
+        all_alleles.update(alleles)
+    candidates = unknown_alleles(list(all_alleles.keys()), session, allele_index)
+    # synonymous alleles whose peptide is known in exactly one locus need no blastp
+    new_allele_pairs = assign_by_peptide(candidates, all_alleles, allele_index)
+    assigned = set(allele_id for allele_id, _ in new_allele_pairs)
+    candidates = [cand for cand in candidates if cand not in assigned]
+    if candidates:
+        new_allele_pairs += blast_for_new_alleles(candidates, all_alleles, ref_db, temp_dir, ref_len, threads)
     if new_allele_pairs:
-        update_database(new_allele_pairs, all_alleles)
+        update_database(new_allele_pairs, all_alleles, session)
 
 
 def profiling(output_dir, input_dir, database, threads, occr_level=None, selected_loci=None,
-              enable_adding_new_alleles=True, generate_profiles=True, logger=None, debug=False):
+              enable_adding_new_alleles=True, generate_profiles=True, logger=None, debug=False,
+              executor="thread", use_cache=True):
     if not logger:
         lf = logs.LoggerFactory()
         lf.addConsoleHandler()
         lf.addFileHandler(files.joinpath(output_dir, "profiling.log"))
         logger = lf.create()
     load_database_config(logger=logger)
+    session = Session(database)
+    allele_index = index.load(session)
 
     logger.info("Formating contigs...")
     query_dir = files.joinpath(output_dir, "query")
@@ -161,34 +278,33 @@ def profiling(output_dir, input_dir, database, threads, occr_level=None, selecte
     if selected_loci:
         selected_loci = set(selected_loci)
     else:  # select loci by scheme
-        query = "select locus_id from loci where occurrence>={};".format(occr_level)
-        selected_loci = set(from_sql(query, database=database).iloc[:, 0])
+        selected_loci = allele_index.select_loci(occr_level)
 
-    logger.info("Making reference blastdb for blastp...")
+    logger.info("Loading reference blastdb for blastp...")
     temp_dir = os.path.join(query_dir, "temp")
     files.create_if_not_exist(temp_dir)
-    ref_db = os.path.join(temp_dir, "ref_blastpdb")
-    ref_len = make_ref_blastpdb(ref_db, database)
+    ref_db, ref_len = cached_ref_blastpdb(session)
 
     logger.info("Identifying loci and allocating alleles...")
-    args = [(os.path.join(query_dir, filename), temp_dir, model)
+    cache_dir = genecalls.cache_dir() if use_cache else None
+    args = [(os.path.join(query_dir, filename), temp_dir, model, cache_dir)
             for filename in os.listdir(query_dir) if filename.endswith(".fa")]
-    with ThreadPoolExecutor(threads) as executor:
-        id_allele_list = list(executor.map(identify_alleles, args))
+    with EXECUTORS[executor](threads) as pool:
+        id_allele_list = list(pool.map(identify_alleles, args))
+    if use_cache:
+        genecalls.prune(cache_dir, settings.GENE_CALL_CACHE_SIZE)
 
     if enable_adding_new_alleles:
         logger.info("Adding new alleles to database...")
-        add_new_alleles(id_allele_list, ref_db, temp_dir, ref_len)
+        add_new_alleles(id_allele_list, ref_db, temp_dir, ref_len, session, allele_index, threads=threads)
 
     logger.info("Collecting allele profiles of each genomes...")
     allele_counts = Counter()
     if generate_profiles:
-        collect = []
+        allele_index = index.load(session)  # reload to include the new alleles
+        result = profile_by_batch(id_allele_list, selected_loci, allele_index)
         for genome_id, alleles in id_allele_list:
-            profile = profile_by_query(alleles, genome_id, selected_loci, database)
-            collect.append(profile)
             allele_counts.update(alleles.keys())
-        result = pd.concat(collect, axis=1)
         result.columns = list(map(lambda x: namemap[x], result.columns))
         result.to_csv(files.joinpath(output_dir, "profile.tsv"), sep="\t")
         bio = to_bionumerics_format(result)
@@ -200,7 +316,10 @@ def profiling(output_dir, input_dir, database, threads, occr_level=None, selecte
 
     allele_counts = pd.DataFrame(allele_counts, index=[0]).T\
         .reset_index().rename(columns={"index": "allele_id", 0: "count"})
-    update_allele_counts(allele_counts, database)
+    update_allele_counts(allele_counts, session)
     if not debug:
         shutil.rmtree(query_dir)
+    stats = pool_stats()
+    logger.info("Connection pool: {} checkouts, {} hits, {} misses, {:.3f}s waiting for connections".format(
+        stats.get("checkouts", 0), stats["pool_hits"], stats["pool_misses"], stats.get("checkout_time", 0)))
     logger.info("Done!")
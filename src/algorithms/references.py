@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.algorithms import distances, search
+from src.utils import nosql
+
+INSERT_BATCH = 1000
+
+
+def read_profiles(path):
+    """Locus x genome tables of a profile.tsv, or of each .tsv file in a directory."""
+    if not os.path.isdir(path):
+        yield pd.read_csv(path, sep="\t", index_col=0, dtype=str)
+        return
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith(".tsv"):
+            yield pd.read_csv(os.path.join(path, filename), sep="\t", index_col=0, dtype=str)
+
+
+class ReferenceLoader:
+    """
+    Insert reference profiles into a tracking collection as allele codes packed against the dictionary of
+    the collection. New alleles of each batch are inserted into the dictionary, as runs of codes from start,
+    before the documents using them, and new loci are registered by an empty run at start 0. Runs are unique
+    by column and start, so a concurrent loader fails instead of giving other alleles the same codes.
+    """
+
+    def __init__(self, track, batch_size=INSERT_BATCH):
+        self.track = track
+        self.batch_size = batch_size
+        search.dictionary_collection(track).create_index([("column", 1), ("start", 1)], unique=True)
+        self.loci, self.alleles = search.load_dictionary(track)
+        self.columns = {locus: i for i, locus in enumerate(self.loci)}
+        self.lookup = [{allele: code + 1 for code, allele in enumerate(x)} for x in self.alleles]
+        self.known = set(x["BioSample"] for x in track.find({}, {"_id": 0, "BioSample": 1}))
+
+    def encode(self, profiles):
+        """Codes of a locus x genome table, returning the columns of the new loci and the new alleles by column."""
+        new_loci, new = [], {}
+        for locus in profiles.index:
+            if locus not in self.columns:
+                new_loci.append(len(self.loci))
+                self.columns[locus] = len(self.loci)
+                self.loci.append(locus)
+                self.alleles.append([])
+                self.lookup.append({})
+        codes = np.zeros((profiles.shape[1], len(self.loci)), dtype=np.uint32)
+        for locus, alleles in zip(profiles.index, profiles.values):
+            i = self.columns[locus]
+            lookup = self.lookup[i]
+            for allele in pd.unique(alleles[~pd.isnull(alleles)]):
+                if allele not in lookup:
+                    lookup[allele] = len(lookup) + 1
+                    self.alleles[i].append(allele)
+                    new.setdefault(i, []).append(allele)
+            codes[:, i] = [lookup.get(x, distances.MISSING) for x in alleles]
+        return codes, new_loci, new
+
+    def save_dictionary(self, new_loci, new):
+        documents = [{"column": i, "locus": self.loci[i], "start": 0, "alleles": []} for i in new_loci]
+        documents += [{"column": i, "locus": self.loci[i], "start": len(self.alleles[i]) - len(alleles) + 1,
+                       "alleles": alleles} for i, alleles in new.items()]
+        if documents:
+            search.dictionary_collection(self.track).insert_many(documents)
+
+    def load(self, profiles):
+        """Insert the genomes of a locus x genome table which are not in the collection yet and return their count."""
+        profiles = profiles.loc[:, [x not in self.known for x in profiles.columns]]
+        profiles = profiles.loc[:, ~profiles.columns.duplicated()]
+        for start in range(0, profiles.shape[1], self.batch_size):
+            batch = profiles.iloc[:, start:start + self.batch_size]
+            codes, new_loci, new = self.encode(batch)
+            self.save_dictionary(new_loci, new)
+            code_dtype = np.dtype(distances.code_dtype(max(len(x) for x in self.alleles) + 1)).newbyteorder("<")
+            codes = codes.astype(code_dtype)
+            self.track.insert_many([{"BioSample": sample, "codes": row.tobytes(), "code_dtype": code_dtype.str}
+                                    for sample, row in zip(batch.columns, codes)], ordered=False)
+            self.known.update(batch.columns)
+        return profiles.shape[1]
+
+
+def load_references(track, tables, batch_size=INSERT_BATCH):
+    """Bulk load locus x genome tables into a tracking collection, returning the number of genomes inserted."""
+    loader = ReferenceLoader(track, batch_size)
+    count = sum(loader.load(profiles) for profiles in tables)
+    track.create_index("BioSample")
+    if count:
+        nosql.bump_epoch(track)
+    return count
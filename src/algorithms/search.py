@@ -0,0 +1,348 @@
+import hashlib
+import heapq
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.algorithms import distances
+
+CHUNK_DOCUMENTS = 5000
+LEAF_SIZE = 64
+TREE_MIN_SAMPLES = 2000
+PROJECTION = {"_id": 0, "BioSample": 1, "profile": 1, "codes": 1, "code_dtype": 1}
+
+_INDEXES = {}
+_LOCK = threading.Lock()
+
+
+def collection_signature(track):
+    """Number of documents and the latest _id of a collection, which change when profiles are added or removed."""
+    last = track.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return track.estimated_document_count(), last["_id"] if last else None
+
+
+def profile_key(query_profile):
+    """SHA-256 of the (locus, allele) pairs of a profile regardless of their order, missing alleles included."""
+    pairs = sorted((str(locus), None if pd.isnull(allele) else allele) for locus, allele in query_profile.items())
+    digest = hashlib.sha256()
+    for pair in pairs:
+        digest.update(repr(pair).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ProfileIndex:
+    """
+    Reference profiles of a tracking collection as a sample x locus matrix of allele codes.
+    Alleles are numbered from 1 within each locus and missing alleles are coded as 0.
+    """
+
+    def __init__(self, samples, loci, codes, dictionaries, signature=None):
+        self.samples = np.array(samples, dtype=object)
+        self.loci = list(loci)
+        self.columns = {locus: i for i, locus in enumerate(self.loci)}
+        self.codes = codes
+        self.dictionaries = dictionaries
+        self.signature = signature
+        self.tree = None
+        self.tree_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    @classmethod
+    def from_documents(cls, documents, signature=None, loci=(), alleles=()):
+        """
+        Index of documents holding either a profile dict or codes packed against the collection dictionary,
+        given as loci in code order and the alleles of each locus.
+        """
+        loci = list(loci)
+        columns = {locus: i for i, locus in enumerate(loci)}
+        dictionaries = [pd.Index(x, dtype=object) for x in alleles]
+        samples, chunks, batch = [], [], []
+        for document in documents:
+            samples.append(document["BioSample"])
+            batch.append(document)
+            if len(batch) == CHUNK_DOCUMENTS:
+                chunks.append(encode_documents(batch, loci, columns, dictionaries))
+                batch = []
+        if batch:
+            chunks.append(encode_documents(batch, loci, columns, dictionaries))
+        max_code = max([len(x) for x in dictionaries] + [0])
+        codes = np.zeros((len(samples), len(loci)), dtype=distances.code_dtype(max_code + 1))
+        start = 0
+        for chunk in chunks:
+            codes[start:start + len(chunk), :chunk.shape[1]] = chunk
+            start += len(chunk)
+        return cls(samples, loci, codes, dictionaries, signature)
+
+    @classmethod
+    def build(cls, track, signature=None):
+        loci, alleles = load_dictionary(track)
+        return cls.from_documents(track.find({}, PROJECTION), signature, loci, alleles)
+
+    def encode(self, query_profile):
+        """
+        Columns and codes of the alleles of a query profile which can match a reference,
+        and the number of query loci which differ from every reference.
+        """
+        columns, codes = [], []
+        for locus, allele in query_profile.items():
+            column = self.columns.get(locus)
+            if column is None or pd.isnull(allele):
+                continue
+            try:
+                code = self.dictionaries[column].get_loc(allele) + 1
+            except KeyError:
+                continue
+            columns.append(column)
+            codes.append(code)
+        return np.array(columns, dtype=np.int64), np.array(codes, dtype=self.codes.dtype), len(query_profile) - len(codes)
+
+    def encode_batch(self, query_profiles):
+        """
+        Columns of the reference loci shared with a locus x genome table of queries, the genome x locus codes of
+        the queries on them, and the number of query loci absent from the references. Alleles which match no
+        reference are given a code no reference has.
+        """
+        shared = np.array([locus in self.columns for locus in query_profiles.index], dtype=bool)
+        columns = np.array([self.columns[locus] for locus in query_profiles.index[shared]], dtype=np.int64)
+        values = query_profiles.values[shared]
+        codes = np.full((query_profiles.shape[1], len(columns)), np.iinfo(self.codes.dtype).max, dtype=self.codes.dtype)
+        for i, column in enumerate(columns):
+            positions = self.dictionaries[column].get_indexer(values[i])
+            codes[positions >= 0, i] = positions[positions >= 0] + 1
+        return columns, codes, len(shared) - len(columns)
+
+    def distances(self, query_profile):
+        """
+        Number of query loci at which each reference differs from the query, where a locus differs
+        if the alleles differ or either is missing. Reference loci absent from the query are ignored.
+        """
+        columns, codes, unmatched = self.encode(query_profile)
+        counts = np.full(len(self.samples), unmatched, dtype=np.int64)
+        rows = max(1, distances.BLOCK_ELEMENTS // max(1, len(columns)))
+        for start in range(0, len(self.samples), rows):
+            block = self.codes[start:start + rows][:, columns]
+            counts[start:start + rows] += np.count_nonzero(block != codes, axis=1)
+        return counts
+
+    def distance_block(self, query_profiles):
+        """Distances of each query of a locus x genome table to every reference as a query x reference matrix."""
+        columns, codes, unmatched = self.encode_batch(query_profiles)
+        block = np.empty((len(codes), len(self.samples)), dtype=np.int64)
+        rows = max(1, distances.BLOCK_ELEMENTS // max(1, len(columns)))
+        for start in range(0, len(self.samples), rows):
+            references = self.codes[start:start + rows][:, columns]
+            block[:, start:start + rows] = distances.cross_distances(codes, references)
+        return block + unmatched
+
+    def nearest(self, query_profile, top_n=100, cutoff=None):
+        """
+        Distances of the top_n closest references within cutoff in increasing order, indexed by BioSample.
+        Large collections are searched through a vantage-point tree, small ones by a full scan.
+        """
+        if len(self.samples) >= TREE_MIN_SAMPLES:
+            with self.tree_lock:
+                if self.tree is None:
+                    self.tree = VPTree(self.codes)
+            counts, selected = self.tree.search(*self.encode(query_profile), top_n=top_n, cutoff=cutoff)
+            return pd.Series(counts, index=self.samples[selected])
+        return self.top(self.distances(query_profile), top_n, cutoff)
+
+    def batch_nearest(self, query_profiles, top_n=100, cutoff=None):
+        """
+        Nearest references of each query of a locus x genome table from a single distance block, the same
+        references in the same order as nearest returns by a full scan or through the vantage-point tree.
+        """
+        block = self.distance_block(query_profiles)
+        return {query: self.top(counts, top_n, cutoff) for query, counts in zip(query_profiles.columns, block)}
+
+    def top(self, counts, top_n, cutoff):
+        """The top_n references by distance then position, as VPTree.search returns them."""
+        if 0 < top_n < len(counts):
+            # every reference tied with the top_n-th is kept, so ties are broken by position below
+            kth = np.partition(counts, top_n - 1)[top_n - 1]
+            selected = np.flatnonzero(counts <= kth)
+        else:
+            selected = np.arange(len(counts))
+        selected = selected[np.lexsort((selected, counts[selected]))][:top_n]
+        if cutoff is not None:
+            selected = selected[counts[selected] <= cutoff]
+        return pd.Series(counts[selected], index=self.samples[selected])
+
+
+class VPTree:
+    """
+    Vantage-point tree over the rows of a code matrix for exact nearest neighbour queries.
+    Each node splits its references by their distance to a vantage point at the median mu,
+    and leaves hold buckets of references which are scanned together.
+    """
+
+    def __init__(self, codes, leaf_size=LEAF_SIZE, seed=0):
+        self.codes = codes
+        self.nodes = []
+        rng = np.random.RandomState(seed)
+        stack = [(self.new_node(), np.arange(len(codes)))]
+        while stack:
+            node, indices = stack.pop()
+            if len(indices) <= leaf_size:
+                self.nodes[node] = (None, None, indices)
+                continue
+            vp = indices[rng.randint(len(indices))]
+            rest = indices[indices != vp]
+            dist = self.reference_distances(vp, rest)
+            mu = np.partition(dist, len(dist) // 2)[len(dist) // 2]
+            if (dist > mu).sum() == 0:
+                # most references are at the same distance, split below it or keep them in a bucket
+                if (dist < mu).sum() == 0:
+                    self.nodes[node] = (None, None, indices)
+                    continue
+                mu = dist[dist < mu].max()
+            inside, outside = self.new_node(), self.new_node()
+            self.nodes[node] = (vp, int(mu), (inside, outside))
+            stack += [(inside, rest[dist <= mu]), (outside, rest[dist > mu])]
+
+    def new_node(self):
+        self.nodes.append(None)
+        return len(self.nodes) - 1
+
+    def reference_distances(self, vp, indices):
+        """Distances between references, where loci missing in either count as different."""
+        vantage = self.codes[vp]
+        dist = np.empty(len(indices), dtype=np.int64)
+        rows = max(1, distances.BLOCK_ELEMENTS // max(1, self.codes.shape[1]))
+        for start in range(0, len(indices), rows):
+            block = self.codes[indices[start:start + rows]]
+            dist[start:start + rows] = np.count_nonzero((block != vantage) | (block == distances.MISSING), axis=1)
+        return dist
+
+    def search(self, columns, codes, unmatched, top_n=100, cutoff=None):
+        """
+        Exact top_n search for an encoded query, returning distances and row positions ordered as a full scan.
+        Subtrees are visited best first by a lower bound of their distances to the query and skipped once the
+        bound exceeds the cutoff or the distance of the current top_n-th reference.
+        """
+        # distances are compared on the query columns, other loci can make references differ by at most excluded
+        excluded = self.codes.shape[1] - len(columns)
+        limit = np.inf if cutoff is None else cutoff - unmatched
+        best = []
+
+        def bound():
+            return min(limit, -best[0][0]) if len(best) == top_n else limit
+
+        def consider(dist, positions):
+            for d, position in zip(dist.tolist(), positions.tolist()):
+                if d > limit:
+                    continue
+                if len(best) < top_n:
+                    heapq.heappush(best, (-d, -position))
+                elif (d, position) < (-best[0][0], -best[0][1]):
+                    heapq.heapreplace(best, (-d, -position))
+
+        queue = [(0, 0)]
+        while queue and top_n > 0:
+            lower, node = heapq.heappop(queue)
+            if lower > bound():
+                break
+            vp, mu, children = self.nodes[node]
+            if vp is None:
+                dist = np.count_nonzero(self.codes[children][:, columns] != codes, axis=1)
+                consider(dist, children)
+                continue
+            d = int(np.count_nonzero(self.codes[vp, columns] != codes))
+            consider(np.array([d]), np.array([vp]))
+            inside, outside = children
+            heapq.heappush(queue, (max(lower, d - mu), inside))
+            heapq.heappush(queue, (max(lower, mu + 1 - excluded - d), outside))
+        found = sorted((-d, -position) for d, position in best)
+        return (np.array([d + unmatched for d, _ in found], dtype=np.int64),
+                np.array([position for _, position in found], dtype=np.int64))
+
+
+def pairwise_distances(profiles):
+    """
+    Distances between the genomes of a locus x genome table as ProfileIndex counts them, where a locus
+    differs if the alleles differ or either is missing, so that they compare with the distances to references.
+    Dendrograms count missing alleles as equal instead, see phylogeny.distance_matrix.
+    """
+    values = profiles.values
+    codes = np.empty((values.shape[1], values.shape[0]), dtype=np.int64)
+    for i, alleles in enumerate(values):
+        codes[:, i] = pd.factorize(alleles)[0]
+    missing = (codes < 0).astype(np.int64)
+    square = distances.cross_distances(codes, codes).astype(np.int64) + missing @ missing.T
+    np.fill_diagonal(square, 0)
+    return pd.DataFrame(square, index=profiles.columns, columns=profiles.columns)
+
+
+def dictionary_collection(track):
+    return track.database[track.name + "_alleles"]
+
+
+def load_dictionary(track):
+    """
+    Loci of a collection in code order and the alleles of each locus, numbered from 1 in packed codes.
+    Each locus is registered by a run without alleles at start 0. Raises a ValueError if a column or
+    a run of codes is missing, as packed codes could not be decoded.
+    """
+    loci, alleles = [], []
+    for document in dictionary_collection(track).find({}, {"_id": 0}, sort=[("column", 1), ("start", 1)]):
+        column = document["column"]
+        if column == len(loci) and document["start"] in (0, 1):
+            loci.append(document["locus"])
+            alleles.append([])
+            if document["start"] == 0:
+                continue
+        if column != len(loci) - 1 or document["start"] != len(alleles[column]) + 1:
+            raise ValueError("Dictionary of {} has a gap at column {} code {}, expected column {} code {}."
+                             .format(track.name, column, document["start"], len(loci) - 1,
+                                     len(alleles[-1]) + 1 if alleles else 1))
+        alleles[column] += document["alleles"]
+    return loci, alleles
+
+
+def encode_documents(documents, loci, columns, dictionaries):
+    """Codes of a chunk of documents, unpacking packed codes and encoding profile dicts with the dictionaries."""
+    legacy = [i for i, document in enumerate(documents) if "codes" not in document]
+    profiles = encode_chunk([documents[i].get("profile") or {} for i in legacy], loci, columns, dictionaries)
+    chunk = np.zeros((len(documents), len(loci)), dtype=np.uint32)
+    chunk[legacy] = profiles
+    for i, document in enumerate(documents):
+        if "codes" in document:
+            codes = np.frombuffer(document["codes"], dtype=document["code_dtype"])
+            chunk[i, :len(codes)] = codes
+    return chunk
+
+
+def encode_chunk(profiles, loci, columns, dictionaries):
+    for profile in profiles:
+        for locus in profile:
+            if locus not in columns:
+                columns[locus] = len(loci)
+                loci.append(locus)
+                dictionaries.append(pd.Index([], dtype=object))
+    values = np.array([[profile.get(locus) for locus in loci] for profile in profiles], dtype=object)
+    values = values.reshape(len(profiles), len(loci))
+    codes = np.zeros(values.shape, dtype=np.uint32)
+    for i, alleles in enumerate(values.T):
+        missing = pd.isnull(alleles)
+        positions = dictionaries[i].get_indexer(alleles)
+        new = (positions < 0) & ~missing
+        if new.any():
+            dictionaries[i] = dictionaries[i].append(pd.Index(pd.unique(alleles[new]), dtype=object))
+            positions = dictionaries[i].get_indexer(alleles)
+        codes[:, i] = np.where(missing, distances.MISSING, positions + 1)
+    return codes
+
+
+def load(track):
+    """Profile index of a tracking collection, kept per worker and rebuilt when the collection changes."""
+    key = (track.database.name, track.name)
+    signature = collection_signature(track)
+    with _LOCK:
+        index = _INDEXES.get(key)
+        if index is None or index.signature != signature:
+            index = ProfileIndex.build(track, signature)
+            _INDEXES[key] = index
+    return index
@@ -18,8 +18,9 @@ def power(database):
     lf.addConsoleHandler()
     logger = lf.create()
     db.load_database_config(logger=logger)
+    session = db.Session(database)
     sql = "select locus_id, count(locus_id) as counts from pairs group by locus_id;"
-    counts = db.from_sql(sql, database=database)
+    counts = session.from_sql(sql)
     counts["log_counts"] = np.log2(counts["counts"])
     return np.sum(counts["log_counts"])
 
@@ -34,15 +35,16 @@ def richness(database, weighted=True):
     lf.addConsoleHandler()
     logger = lf.create()
     db.load_database_config(logger=logger)
+    session = db.Session(database)
     sql = "select a.locus_id, a.allele_id, b.count" \
           " from pairs as a" \
           " left join (select allele_id, count from alleles) as b" \
           " on a.allele_id=b.allele_id;"
-    counts = db.from_sql(sql, database=database)
+    counts = session.from_sql(sql)
     ent = counts.groupby("locus_id").agg({"count": locus_entropy})
     if weighted:
         sql = "select locus_id, occurrence from loci;"
-        loci = db.from_sql(sql, database=database)
+        loci = session.from_sql(sql)
         weight = pd.merge(ent, loci, left_index=True, right_on="locus_id")
         return np.average(weight["count"], weights=weight["occurrence"])
     else:
@@ -57,7 +59,7 @@ def calculate_loci_coverage(input_dir, output_dir, database):
     logger.info("Start calculating locus coverage...")
     subject_number = count_subjects(input_dir)
     logger.info("Start plotting locus coverage...")
-    plot_stats(output_dir, subject_number, database)
+    plot_stats(output_dir, subject_number, db.Session(database))
 
 
 def count_subjects(input_dir):
@@ -68,9 +70,9 @@ def count_subjects(input_dir):
     return len(genomes)
 
 
-def plot_stats(output_dir, subject_number, database):
+def plot_stats(output_dir, subject_number, session):
     sql = "select locus_id, num_isolates, is_paralog from locus_meta where is_paralog=FALSE;"
-    table = db.from_sql(sql, database=database)
+    table = session.from_sql(sql)
     table["owned by"] = [int(x / subject_number * 100) for x in table["num_isolates"]]
     plot_genome_coverage(table["owned by"], output_dir, perc=0)
     plot_genome_coverage(table["owned by"], output_dir)
@@ -99,14 +101,14 @@ def calculate_allele_length(output_dir, database, interval=20):
     logger = lf.create()
     db.load_database_config(logger=logger)
     logger.info("Start calculating allele length heatmap...")
-    plot_length_heamap(output_dir, database, interval=interval)
+    plot_length_heamap(output_dir, db.Session(database), interval=interval)
 
 
-def plot_length_heamap(output_dir, database, interval):
+def plot_length_heamap(output_dir, session, interval):
     output_file = os.path.join(output_dir, "allele_length_heatmap.png")
-    allele_info = get_allele_info(database)
+    allele_info = get_allele_info(session)
     allele_info["intervals"] = list(map(lambda x: (int(x / interval) + 1) * interval, allele_info["length"]))
-    pairs = db.from_sql("select * from pairs;", database=database)
+    pairs = session.from_sql("select * from pairs;")
     collect = []
     for locus_id, df in pairs.groupby("locus_id"):
         df2 = pd.merge(df, allele_info, on="allele_id", how="left")
@@ -117,7 +119,7 @@ def plot_length_heamap(output_dir, database, interval):
     table = table.apply(lambda x: 100 * x / np.sum(x), axis=1)
 
     # sort by scheme order
-    freq = db.from_sql("select locus_id from loci order by occurrence DESC;", database=database)
+    freq = session.from_sql("select locus_id from loci order by occurrence DESC;")
     table = pd.merge(freq, table, left_on="locus_id", right_index=True).set_index("locus_id")
 
     table = table.apply(mask_by_length, axis=1).apply(np.floor, axis=1)
@@ -133,9 +135,9 @@ def plot_length_heamap(output_dir, database, interval):
     plt.savefig(output_file)
 
 
-def get_allele_info(database):
+def get_allele_info(session):
     sql = "select allele_id, char_length(dna_seq) as length, count from alleles;"
-    return db.from_sql(sql, database=database)
+    return session.from_sql(sql)
 
 
 def mask_by_length(x):
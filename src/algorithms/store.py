@@ -0,0 +1,227 @@
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from src.algorithms import distances, phylogeny
+from src.utils import files
+from src.utils.index import locked
+
+MAX_GRAPH_EDGES = 2 ** 24
+CHUNK_GENOMES = 256
+COLLECTION_PATTERN = r"^[A-Za-z0-9_-]{1,100}$"
+
+
+def store_dir(collection):
+    """Directory of a collection, whose name must be a slug so that it stays under CACHE_ROOT."""
+    if not isinstance(collection, str) or not re.match(COLLECTION_PATTERN, collection):
+        raise ValueError("Invalid collection name {!r}.".format(collection))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benga.settings")
+    root = os.path.realpath(os.path.join(settings.CACHE_ROOT, "profile_store"))
+    path = os.path.realpath(os.path.join(root, collection))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError("Collection {!r} is outside of {}.".format(collection, root))
+    return files.joinpath(root, collection)
+
+
+def sparse_mst(n, rows, cols, weights):
+    """Minimum spanning tree of a sparse graph, with weights shifted by one as csgraph drops zero weights."""
+    graph = coo_matrix((np.asarray(weights, dtype=float) + 1, (rows, cols)), shape=(n, n))
+    tree = minimum_spanning_tree(graph).tocoo()
+    return [(int(i), int(j), float(d) - 1) for i, j, d in zip(tree.row, tree.col, tree.data)]
+
+
+class ProfileStore:
+    """
+    Encoded profiles of a collection of genomes with their pairwise distances and minimum spanning tree.
+    Files only grow: allele dictionaries and codes are appended, and the distances of each genome to
+    the genomes added before it are appended in lower triangular order. Codes are written to a new file
+    when loci are added or alleles outgrow the code type. meta.json records the valid size of each file
+    and is replaced last, so an interrupted update is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reload()
+
+    @classmethod
+    def open(cls, collection):
+        return cls(store_dir(collection))
+
+    def __len__(self):
+        return len(self.genomes)
+
+    def file(self, name):
+        return files.joinpath(self.path, name)
+
+    def reload(self):
+        meta = {"loci": [], "genomes": [], "code_dtype": "uint16", "sizes": {}, "mst": []}
+        if os.path.exists(self.file("meta.json")):
+            with open(self.file("meta.json"), "r") as file:
+                meta = json.load(file)
+        self.loci = meta["loci"]
+        self.genomes = meta["genomes"]
+        self.scheme = meta.get("scheme")
+        self.code_dtype = np.dtype(meta["code_dtype"])
+        self.sizes = meta["sizes"]
+        self.codes_file = meta.get("codes_file", "codes.{}.bin".format(self.code_dtype.name))
+        self.mst = [tuple(x) for x in meta["mst"]]
+        self.dictionaries = [{} for _ in self.loci]
+        if self.sizes.get("alleles.tsv"):
+            with open(self.file("alleles.tsv"), "rb") as file:
+                for line in file.read(self.sizes["alleles.tsv"]).decode("utf-8").splitlines():
+                    locus, allele = line.split("\t")
+                    dictionary = self.dictionaries[int(locus)]
+                    dictionary[allele] = len(dictionary) + 1
+
+    def codes(self):
+        if not self.genomes:
+            return np.empty((0, len(self.loci)), dtype=self.code_dtype)
+        return np.memmap(self.file(self.codes_file), dtype=self.code_dtype, mode="r",
+                         shape=(len(self.genomes), len(self.loci)))
+
+    def distances(self):
+        """Distances of each genome to the previous ones, the pair (i, j) with i < j at lower_index(j) + i."""
+        n = len(self.genomes)
+        if n < 2:
+            return np.empty(0, dtype=distances.distance_dtype(len(self.loci)))
+        return np.memmap(self.file("distances.bin"), dtype=distances.distance_dtype(len(self.loci)), mode="r",
+                         shape=(distances.lower_index(n),))
+
+    def append(self, name, data, sizes):
+        filename = self.file(name)
+        with open(filename, "ab") as file:
+            file.truncate(sizes.get(name, 0))
+            file.write(data)
+        sizes[name] = sizes.get(name, 0) + len(data)
+
+    def encode(self, profiles):
+        """Encode a locus x genome table with the dictionaries of the store, returning the new dictionary lines."""
+        values = profiles.fillna("0").values
+        codes = np.zeros((values.shape[1], values.shape[0]), dtype=np.uint32)
+        lines = []
+        for i, alleles in enumerate(values):
+            dictionary = self.dictionaries[i]
+            for allele in pd.unique(alleles):
+                if allele != "0" and allele not in dictionary:
+                    dictionary[allele] = len(dictionary) + 1
+                    lines.append("{}\t{}\n".format(i, allele))
+            codes[:, i] = [dictionary.get(x, distances.MISSING) for x in alleles]
+        return codes, "".join(lines)
+
+    def check_duplicates(self, profiles):
+        """Raise a ValueError if a genome of profiles is repeated, or already stored, with a different profile."""
+        conflicts = []
+        for name in pd.unique(profiles.columns[profiles.columns.duplicated()]):
+            same = profiles.loc[:, profiles.columns == name].fillna("0").values
+            if (same != same[:, :1]).any():
+                conflicts.append(name)
+        rows = {genome: i for i, genome in enumerate(self.genomes)}
+        stored = [x for x in pd.unique(profiles.columns) if x in rows]
+        if stored:
+            batch = profiles.loc[:, ~profiles.columns.duplicated()][stored].fillna("0")
+            codes = np.asarray(self.codes())[[rows[x] for x in stored]]
+            differs = np.zeros(len(stored), dtype=bool)
+            for i, alleles in enumerate(batch.reindex(self.loci).fillna("0").values):
+                dictionary = self.dictionaries[i]
+                differs |= codes[:, i] != [distances.MISSING if x == "0" else dictionary.get(x, -1) for x in alleles]
+            known_loci = set(self.loci)
+            differs |= (batch.loc[[x not in known_loci for x in batch.index]] != "0").any(axis=0).values
+            conflicts += [x for x, d in zip(stored, differs) if d]
+        if conflicts:
+            raise ValueError("Genomes {} have another profile than in the store.".format(", ".join(map(str, conflicts))))
+
+    def add(self, profiles, scheme=None):
+        """
+        Add the genomes of a locus x genome table which are not in the store yet and return their names.
+        Only the distances from the new genomes are computed, and the minimum spanning tree is updated
+        from its previous edges and the edges to the new genomes. Loci new to the store are missing in
+        the stored genomes. Profiles of another scheme, such as another allele database, are rejected,
+        as well as genomes repeated or already stored with a different profile.
+        """
+        files.create_if_not_exist(self.path)
+        with locked(self.path):
+            self.reload()
+            if scheme and self.scheme and scheme != self.scheme:
+                raise ValueError("Profiles of scheme {} cannot be added to a store of scheme {}."
+                                 .format(scheme, self.scheme))
+            self.check_duplicates(profiles)
+            known = set(self.genomes)
+            profiles = profiles.loc[:, [x not in known for x in profiles.columns]]
+            profiles = profiles.loc[:, ~profiles.columns.duplicated()]
+            if profiles.empty:
+                return []
+            stored_codes = self.codes()
+            known_loci = set(self.loci)
+            new_loci = [x for x in pd.unique(profiles.index) if x not in known_loci]
+            self.loci = self.loci + new_loci
+            self.dictionaries += [{} for _ in new_loci]
+            new_codes, lines = self.encode(profiles.reindex(self.loci))
+
+            sizes = dict(self.sizes)
+            code_dtype = np.dtype(distances.code_dtype(max([len(x) for x in self.dictionaries] + [0]) + 1))
+            codes_file = "codes.{}.{}.bin".format(code_dtype.name, len(self.loci))
+            if codes_file != self.codes_file:
+                # loci were added or alleles outgrew the code type, codes are written again to a new file
+                codes = np.zeros((len(stored_codes), len(self.loci)), dtype=code_dtype)
+                codes[:, :stored_codes.shape[1]] = stored_codes
+                sizes.pop(self.codes_file, None)
+                self.code_dtype, self.codes_file = code_dtype, codes_file
+                self.append(self.codes_file, codes.tobytes(), sizes)
+            else:
+                codes = stored_codes
+            new_codes = new_codes.astype(self.code_dtype)
+            self.append("alleles.tsv", lines.encode("utf-8"), sizes)
+
+            n, k = len(self.genomes), len(new_codes)
+            new_rows = [] if k * (n + k) <= MAX_GRAPH_EDGES else None
+            for start in range(0, k, CHUNK_GENOMES):
+                chunk = new_codes[start:start + CHUNK_GENOMES]
+                block = np.hstack([distances.cross_distances(chunk, codes),
+                                   distances.cross_distances(chunk, new_codes[:start + len(chunk)])])
+                rows = [block[t, :n + start + t] for t in range(len(chunk))]
+                self.append("distances.bin", b"".join(x.tobytes() for x in rows), sizes)
+                if new_rows is not None:
+                    new_rows += rows
+            self.append(self.codes_file, new_codes.tobytes(), sizes)
+            genomes = self.genomes + list(profiles.columns)
+            mst = self.update_mst(new_rows, n, k)
+
+            meta = {"loci": self.loci, "genomes": genomes, "scheme": self.scheme or scheme,
+                    "code_dtype": self.code_dtype.name, "codes_file": self.codes_file,
+                    "sizes": sizes, "mst": [list(x) for x in mst]}
+            with open(self.file("meta.json.tmp"), "w") as file:
+                json.dump(meta, file)
+            os.replace(self.file("meta.json.tmp"), self.file("meta.json"))
+            self.reload()
+            for filename in os.listdir(self.path):
+                if filename.startswith("codes.") and filename != self.codes_file:
+                    os.remove(self.file(filename))
+        return list(profiles.columns)
+
+    def update_mst(self, new_rows, n, k):
+        """
+        Minimum spanning tree after adding k genomes, from the previous tree and the distances of each new genome
+        to the genomes before it, or from all stored distances if new_rows is None.
+        """
+        total = n + k
+        if new_rows is None:
+            stored = np.memmap(self.file("distances.bin"), dtype=distances.distance_dtype(len(self.loci)), mode="r",
+                               shape=(distances.lower_index(total),))
+            return distances.prim_mst(total, lambda v, rows: distances.lower_row(stored, total, v)[rows])
+        old = np.array(self.mst, dtype=float).reshape(-1, 3)
+        rows = np.concatenate([old[:, 0], np.repeat(np.arange(n, total), np.arange(n, total))])
+        cols = np.concatenate([old[:, 1]] + [np.arange(n + t) for t in range(k)])
+        weights = np.concatenate([old[:, 2]] + new_rows)
+        return sparse_mst(total, rows.astype(np.int64), cols.astype(np.int64), weights)
+
+    def dendrogram(self):
+        """Single linkage dendrogram of all genomes in the store."""
+        dendro = phylogeny.Dendrogram()
+        dendro.load_mst(self.genomes, self.mst)
+        return dendro
@@ -1,56 +1,171 @@
+import io
 import os
 import subprocess
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 import pandas as pd
-from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey
+from sqlalchemy import create_engine, event, exc, MetaData, Table, Column, ForeignKey
 from sqlalchemy.engine.url import URL
 from sqlalchemy.dialects import postgresql
 from django.conf import settings
 
 DBCONFIG = {}
+POOLCONFIG = {}
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+_POOL_STATS = Counter()
 
 
 def load_database_config(logger=None):
-    global DBCONFIG
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benga.settings")
     DBCONFIG["drivername"] = "postgresql+psycopg2"
     DBCONFIG["host"] = settings.DATABASES['default']['HOST']
     DBCONFIG["port"] = settings.DATABASES['default']['PORT']
     DBCONFIG["username"] = settings.DATABASES['default']['USER']
     DBCONFIG["password"] = settings.DATABASES['default']['PASSWORD']
+    POOLCONFIG.update(getattr(settings, "SQLALCHEMY_POOL", {}))
     logger.info("Database: {}:{}".format(DBCONFIG["host"], DBCONFIG["port"]))
     logger.info("Login database as USER {} with PASSWORD ******".format(DBCONFIG["username"]))
 
 
-def from_sql(query, database=None):
-    global DBCONFIG
-    if database:
-        DBCONFIG["database"] = database
-    engine = create_engine(URL(**DBCONFIG))
-    with engine.connect() as conn:
-        t = pd.read_sql_query(query, con=conn)
-    engine.dispose()
-    return t
+def count_pool_event(name, value=1):
+    with _ENGINES_LOCK:
+        _POOL_STATS[name] += value
+
+
+def pool_stats():
+    """Counters of the connection pools in this process."""
+    with _ENGINES_LOCK:
+        stats = dict(_POOL_STATS)
+    stats["pool_misses"] = stats.get("connects", 0)
+    stats["pool_hits"] = stats.get("checkouts", 0) - stats["pool_misses"]
+    return stats
+
+
+def make_engine(config):
+    engine = create_engine(URL(**config), **POOLCONFIG)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+        count_pool_event("connects")
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # connections inherited from a parent process must not be shared with it
+        if connection_record.info["pid"] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection record belongs to pid {}, attempting to check out "
+                                         "in pid {}".format(connection_record.info["pid"], os.getpid()))
+        count_pool_event("checkouts")
+
+    return engine
+
+
+def get_engine(database):
+    """
+    Engine of database from the registry of this process. Engines are keyed by pid, so a forked
+    worker creates its own engines and leaves the connections of its parent untouched.
+    """
+    if not database:
+        raise ValueError("A target database is required.")
+    config = dict(DBCONFIG, database=database)
+    key = (os.getpid(), tuple(sorted(config.items())))
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+        _POOL_STATS["engine_hits" if engine else "engine_misses"] += 1
+        if not engine:
+            engine = _ENGINES[key] = make_engine(config)
+    return engine
+
+
+class Session:
+    """
+    Target of queries on one database. Sessions hold no connection of their own, so one session or
+    several sessions on different databases can be used from concurrent threads.
+    """
+
+    def __init__(self, database):
+        if not database:
+            raise ValueError("A target database is required.")
+        self.database = database
+
+    def __repr__(self):
+        return "Session({!r})".format(self.database)
+
+    @contextmanager
+    def connect(self):
+        engine = get_engine(self.database)
+        start = time.perf_counter()
+        conn = engine.connect()
+        count_pool_event("checkout_time", time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def from_sql(self, query, params=None):
+        with self.connect() as conn:
+            t = pd.read_sql_query(query, con=conn, params=params)
+        return t
+
+    def to_sql(self, sql, args={}):
+        with self.connect() as conn:
+            conn.execute(sql, **args)
+
+    def table_to_sql(self, table, df, append=True):
+        if_exists = "append" if append else "fail"
+        with self.connect() as conn:
+            df.to_sql(table, conn, index=False, chunksize=3000, if_exists=if_exists)
+
+    def copy_merge(self, merges):
+        """
+        Stage DataFrames into temporary tables with COPY FROM STDIN and merge them into their tables
+        in a single transaction. merges is a list of (table, df, statement), where statement refers to
+        the staged rows of df as {staging}.
+        """
+        engine = get_engine(self.database)
+        start = time.perf_counter()
+        conn = engine.raw_connection()
+        count_pool_event("checkout_time", time.perf_counter() - start)
+        try:
+            with conn.cursor() as cursor:
+                for i, (table, df, statement) in enumerate(merges):
+                    staging = "staging_{}_{}".format(table, i)
+                    columns = ", ".join(df.columns)
+                    # temporary tables are not WAL-logged and private to the session
+                    cursor.execute("create temporary table {} on commit drop as "
+                                   "select {} from {} with no data;".format(staging, columns, table))
+                    buffer = io.StringIO()
+                    df.to_csv(buffer, index=False, header=False)
+                    buffer.seek(0)
+                    cursor.copy_expert("copy {} ({}) from stdin with (format csv);".format(staging, columns), buffer)
+                    cursor.execute(statement.format(staging=staging))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def from_sql(query, database=None, params=None):
+    return Session(database).from_sql(query, params=params)
 
 
 def to_sql(sql, args={}, database=None):
-    global DBCONFIG
-    if database:
-        DBCONFIG["database"] = database
-    engine = create_engine(URL(**DBCONFIG))
-    with engine.connect() as conn:
-        conn.execute(sql, **args)
-    engine.dispose()
+    Session(database).to_sql(sql, args=args)
 
 
 def table_to_sql(table, df, database=None, append=True):
-    global DBCONFIG
-    if database:
-        DBCONFIG["database"] = database
-    if_exists = "append" if append else "fail"
-    engine = create_engine(URL(**DBCONFIG))
-    with engine.connect() as conn:
-        df.to_sql(table, conn, index=False, chunksize=3000, if_exists=if_exists)
-    engine.dispose()
+    Session(database).table_to_sql(table, df, append=append)
+
+
+def copy_merge(merges, database=None):
+    Session(database).copy_merge(merges)
 
 
 def createdb(dbname):
@@ -58,9 +173,7 @@ def createdb(dbname):
 
 
 def create_pgadb_relations(dbname):
-    global DBCONFIG
-    DBCONFIG["database"] = dbname
-    engine = create_engine(URL(**DBCONFIG))
+    engine = get_engine(dbname)
     metadata = MetaData()
     loci = Table("loci", metadata,
                  Column("locus_id", None, ForeignKey("locus_meta.locus_id", ondelete="CASCADE"),
@@ -85,4 +198,3 @@ def create_pgadb_relations(dbname):
                        Column("description", postgresql.TEXT),
                        Column("is_paralog", postgresql.BOOLEAN))
     metadata.create_all(engine)
-    engine.dispose()
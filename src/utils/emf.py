@@ -0,0 +1,114 @@
+import struct
+
+EMR_HEADER = 1
+EMR_POLYPOLYLINE = 7
+EMR_EOF = 14
+EMR_SETMAPMODE = 17
+EMR_SETBKMODE = 18
+EMR_SETTEXTALIGN = 22
+EMR_SETTEXTCOLOR = 24
+EMR_SELECTOBJECT = 37
+EMR_CREATEPEN = 38
+EMR_EXTCREATEFONTINDIRECTW = 82
+EMR_EXTTEXTOUTW = 84
+
+MM_TEXT = 1
+TRANSPARENT = 1
+TA_LEFT = 0
+TA_RIGHT = 2
+TA_CENTER = 6
+TA_BASELINE = 24
+GM_COMPATIBLE = 1
+
+# logical units are pixels of a 96 dpi reference device
+DPI = 96
+REFERENCE_PIXELS = 9600
+REFERENCE_MILLIMETERS = 2540
+
+
+def color(hex_color):
+    """COLORREF of a #rrggbb color."""
+    r, g, b = (int(hex_color[i:i + 2], 16) for i in (1, 3, 5))
+    return r | (g << 8) | (b << 16)
+
+
+def bounds(points):
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return struct.pack("<4i", min(xs), min(ys), max(xs), max(ys))
+
+
+class Metafile:
+    """
+    Minimal writer of Enhanced Metafiles (EMF) with lines and text,
+    enough to draw dendrograms without converting an SVG.
+    """
+
+    def __init__(self, width, height):
+        self.width = int(width)
+        self.height = int(height)
+        self.records = [struct.pack("<3I", EMR_SETMAPMODE, 12, MM_TEXT),
+                        struct.pack("<3I", EMR_SETBKMODE, 12, TRANSPARENT)]
+        self.handles = 0
+
+    def record(self, record_type, data):
+        self.records.append(struct.pack("<2I", record_type, 8 + len(data)) + data)
+
+    def create_pen(self, hex_color="#000000", width=1):
+        self.handles += 1
+        self.record(EMR_CREATEPEN, struct.pack("<2I2iI", self.handles, 0, width, 0, color(hex_color)))
+        return self.handles
+
+    def create_font(self, height, face="Arial", weight=400):
+        self.handles += 1
+        face_name = face.encode("utf-16-le")[:62].ljust(64, b"\0")
+        logfont = struct.pack("<5i8B", -height, 0, 0, 0, weight, 0, 0, 0, 1, 0, 0, 0, 0) + face_name
+        self.record(EMR_EXTCREATEFONTINDIRECTW, struct.pack("<I", self.handles) + logfont)
+        return self.handles
+
+    def select(self, handle):
+        self.record(EMR_SELECTOBJECT, struct.pack("<I", handle))
+
+    def text_align(self, align):
+        self.record(EMR_SETTEXTALIGN, struct.pack("<I", align))
+
+    def text_color(self, hex_color):
+        self.record(EMR_SETTEXTCOLOR, struct.pack("<I", color(hex_color)))
+
+    def polylines(self, lines):
+        """Draw a list of polylines, each a list of (x, y) points, in a single record."""
+        lines = [[(int(round(x)), int(round(y))) for x, y in line] for line in lines]
+        points = [point for line in lines for point in line]
+        if not points:
+            return
+        data = bounds(points) + struct.pack("<2I", len(lines), len(points))
+        data += struct.pack("<{}I".format(len(lines)), *[len(line) for line in lines])
+        data += struct.pack("<{}i".format(2 * len(points)), *[c for point in points for c in point])
+        self.record(EMR_POLYPOLYLINE, data)
+
+    def text(self, x, y, string):
+        chars = string.encode("utf-16-le")
+        chars += b"\0" * (-len(chars) % 4)
+        x, y = int(round(x)), int(round(y))
+        # type, size, bounds, graphics mode and scales come before the text object
+        offset = 8 + 16 + 12 + 40
+        data = struct.pack("<4iIff", 0, 0, -1, -1, GM_COMPATIBLE, 0, 0)
+        data += struct.pack("<2i3I4iI", x, y, len(string), offset, 0, 0, 0, -1, -1, 0)
+        self.record(EMR_EXTTEXTOUTW, data + chars)
+
+    def header(self, size, n_records):
+        frame = [round(x * 2540 / DPI) for x in (self.width, self.height)]
+        data = struct.pack("<4i4i", 0, 0, self.width - 1, self.height - 1, 0, 0, frame[0], frame[1])
+        data += struct.pack("<4I2H3I", 0x464D4520, 0x10000, size, n_records, self.handles + 1, 0, 0, 0, 0)
+        data += struct.pack("<4i", REFERENCE_PIXELS, REFERENCE_PIXELS, REFERENCE_MILLIMETERS, REFERENCE_MILLIMETERS)
+        data += struct.pack("<3I2I", 0, 0, 0, REFERENCE_MILLIMETERS * 1000, REFERENCE_MILLIMETERS * 1000)
+        return struct.pack("<2I", EMR_HEADER, 8 + len(data)) + data
+
+    def save(self, file):
+        eof = struct.pack("<5I", EMR_EOF, 20, 0, 16, 20)
+        body = b"".join(self.records) + eof
+        header = self.header(0, len(self.records) + 2)
+        header = self.header(len(header) + len(body), len(self.records) + 2)
+        with open(file, "wb") as handle:
+            handle.write(header)
+            handle.write(body)
@@ -0,0 +1,77 @@
+import gzip
+import hashlib
+import json
+import os
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from django.conf import settings
+
+from src.utils import files, operations
+
+
+def cache_dir():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benga.settings")
+    return files.joinpath(settings.CACHE_ROOT, "gene_calls")
+
+
+def contig_key(filename, model):
+    """SHA-256 of the contig sequences of a fasta file, regardless of headers and case, and the prodigal model."""
+    digest = hashlib.sha256(model.encode("ascii"))
+    with open(filename, "r") as file:
+        for _, contig in SimpleFastaParser(file):
+            digest.update(b">")
+            digest.update(contig.upper().encode("ascii"))
+    return digest.hexdigest()
+
+
+def entry_path(path, key):
+    return files.joinpath(path, key + ".json.gz")
+
+
+def get(path, key):
+    filename = entry_path(path, key)
+    try:
+        with gzip.open(filename, "rt") as file:
+            alleles = json.load(file)
+    except (OSError, ValueError):
+        return None
+    os.utime(filename)  # mark as recently used
+    return {allele_id: tuple(x) for allele_id, x in alleles.items()}
+
+
+def put(path, key, alleles):
+    files.create_if_not_exist(path)
+    filename = entry_path(path, key)
+    temp_file = "{}.{}.tmp".format(filename, operations.create_uuid())
+    with gzip.open(temp_file, "wt") as file:
+        json.dump(alleles, file)
+    os.replace(temp_file, filename)
+
+
+def entries(path):
+    if not os.path.exists(path):
+        return []
+    collect = []
+    for filename in os.listdir(path):
+        if filename.endswith(".json.gz"):
+            try:
+                stat = os.stat(files.joinpath(path, filename))
+            except FileNotFoundError:  # evicted by another process
+                continue
+            collect.append((filename[:-len(".json.gz")], stat.st_size, stat.st_mtime))
+    return sorted(collect, key=lambda x: x[2], reverse=True)
+
+
+def prune(path, max_bytes):
+    """Evict least recently used entries until the cache is not larger than max_bytes."""
+    total = 0
+    removed = []
+    for key, size, _ in entries(path):
+        total += size
+        if total > max_bytes:
+            try:
+                os.remove(entry_path(path, key))
+            except FileNotFoundError:
+                continue
+            removed.append(key)
+    return removed
@@ -0,0 +1,259 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from src.utils import files, operations
+
+INDEX_FORMAT = 2
+HASH_DTYPE = "S32"
+LOCUS_DTYPE = np.int32
+AMBIGUOUS = -1
+ARRAYS = ["alleles", "loci", "peptides", "peptide_loci"]
+
+_INDEXES = {}
+_LOCK = threading.Lock()
+
+
+def to_binary(allele_ids):
+    return np.frombuffer(bytes.fromhex("".join(allele_ids)), dtype=HASH_DTYPE)
+
+
+def search(sorted_keys, keys):
+    pos = np.searchsorted(sorted_keys, keys)
+    found = pos < len(sorted_keys)
+    found[found] = sorted_keys[pos[found]] == keys[found]
+    return pos, found
+
+
+def index_dir(database):
+    return files.joinpath(settings.CACHE_ROOT, "allele_index", "v{}".format(INDEX_FORMAT), database)
+
+
+@contextmanager
+def locked(path):
+    files.create_if_not_exist(path)
+    with open(files.joinpath(path, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class AlleleIndex:
+    """
+    Allele to locus pairs of an allele database with the occurrence of loci, and
+    peptide to locus pairs for peptides which belong to a single locus.
+    Hashes are kept as sorted 32-byte keys in memory-mapped files.
+    """
+
+    def __init__(self, path, version, alleles, locus_codes, peptides, peptide_codes, loci, occurrence,
+                 pair_count=None):
+        self.path = path
+        self.version = version
+        self.pair_count = pair_count
+        self.alleles = alleles
+        self.locus_codes = locus_codes
+        self.peptides = peptides
+        self.peptide_codes = peptide_codes
+        self.loci = np.array(loci, dtype=object)
+        self.occurrence = np.array(occurrence, dtype=float)
+        self.mtime = None
+
+    def __len__(self):
+        return len(self.alleles)
+
+    @classmethod
+    def open(cls, path):
+        with open(files.joinpath(path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        version = meta["version"]
+        arrays = [np.load(files.joinpath(path, "{}.{}.npy".format(name, version)), mmap_mode="r")
+                  for name in ARRAYS]
+        return cls(path, version, *arrays, meta["loci"], meta["occurrence"], meta.get("pairs"))
+
+    def save(self, path, arrays, loci, occurrence, pair_count):
+        version = self.version + 1
+        for name, array in zip(ARRAYS, arrays):
+            # arrays are written to new files, as other processes may have the current ones memory-mapped
+            filename = files.joinpath(path, "{}.{}.npy".format(name, version))
+            temp_file = "{}.{}.tmp".format(filename, operations.create_uuid())
+            with open(temp_file, "wb") as file:
+                np.save(file, array)
+            os.replace(temp_file, filename)
+        meta_file = files.joinpath(path, "meta.json")
+        with open(meta_file + ".tmp", "w") as file:
+            json.dump({"version": version, "loci": list(loci), "occurrence": list(occurrence),
+                       "pairs": pair_count}, file)
+        os.replace(meta_file + ".tmp", meta_file)
+        # keep the previous version for readers which have not seen the new meta.json yet
+        for filename in os.listdir(path):
+            if filename.endswith(".npy") and int(filename.split(".")[-2]) not in (version, version - 1):
+                os.remove(files.joinpath(path, filename))
+        return AlleleIndex.open(path)
+
+    def select_loci(self, occr_level):
+        return set(self.loci[self.occurrence >= occr_level])
+
+    def pairs(self, allele_ids):
+        keys = to_binary(allele_ids)
+        start = np.searchsorted(self.alleles, keys, side="left")
+        end = np.searchsorted(self.alleles, keys, side="right")
+        counts = end - start
+        offsets = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts, counts)
+        positions = np.repeat(start, counts) + offsets
+        return pd.DataFrame({"allele_id": np.repeat(np.asarray(allele_ids, dtype=object), counts),
+                             "locus_id": self.loci[self.locus_codes[positions]]})
+
+    def contains(self, allele_ids):
+        _, found = search(self.alleles, to_binary(allele_ids))
+        return found
+
+    def peptide_loci(self, peptide_ids):
+        keys = to_binary(peptide_ids)
+        pos, found = search(self.peptides, keys)
+        codes = np.full(len(keys), AMBIGUOUS, dtype=LOCUS_DTYPE)
+        codes[found] = self.peptide_codes[pos[found]]
+        loci = np.full(len(keys), None, dtype=object)
+        loci[codes != AMBIGUOUS] = self.loci[codes[codes != AMBIGUOUS]]
+        return loci
+
+    def merge(self, pairs, peptides, pair_count=None):
+        loci = list(self.loci)
+        occurrence = list(self.occurrence)
+        codes = {locus: i for i, locus in enumerate(loci)}
+        for locus in set(pairs["locus_id"]) | set(peptides["locus_id"]):
+            if locus not in codes:
+                codes[locus] = len(loci)
+                loci.append(locus)
+                occurrence.append(np.nan)
+        alleles = np.concatenate([self.alleles, to_binary(pairs["allele_id"])])
+        locus_codes = np.concatenate([self.locus_codes,
+                                      np.array([codes[x] for x in pairs["locus_id"]], dtype=LOCUS_DTYPE)])
+        # keep pairs in the order of (allele_id, locus_id) as the database would sort them
+        rank = np.argsort(np.argsort(np.array(loci, dtype=str)))
+        order = np.lexsort((rank[locus_codes], alleles))
+        alleles, locus_codes = alleles[order], locus_codes[order]
+        is_new = np.ones(len(alleles), dtype=bool)
+        is_new[1:] = (alleles[1:] != alleles[:-1]) | (locus_codes[1:] != locus_codes[:-1])
+        alleles, locus_codes = alleles[is_new], locus_codes[is_new]
+
+        # peptides found in more than one locus are marked as ambiguous
+        peptide_keys = np.concatenate([self.peptides, to_binary(peptides["peptide_id"])])
+        peptide_codes = np.concatenate([self.peptide_codes,
+                                        np.array([codes[x] for x in peptides["locus_id"]], dtype=LOCUS_DTYPE)])
+        order = np.argsort(peptide_keys, kind="stable")
+        peptide_keys, peptide_codes = peptide_keys[order], peptide_codes[order]
+        first = np.ones(len(peptide_keys), dtype=bool)
+        first[1:] = peptide_keys[1:] != peptide_keys[:-1]
+        group = np.cumsum(first) - 1
+        conflict = np.zeros(first.sum(), dtype=bool)
+        np.logical_or.at(conflict, group[1:], (~first[1:]) & (peptide_codes[1:] != peptide_codes[:-1]))
+        peptide_codes = np.where(conflict, AMBIGUOUS, peptide_codes[first]).astype(LOCUS_DTYPE)
+        peptide_keys = peptide_keys[first]
+
+        return self.save(self.path, [alleles, locus_codes, peptide_keys, peptide_codes], loci, occurrence, pair_count)
+
+
+def peptide_pairs(peptide_seqs, locus_ids):
+    return pd.DataFrame({"peptide_id": [operations.make_seqid(x) for x in peptide_seqs],
+                         "locus_id": list(locus_ids)})
+
+
+def pair_count(session):
+    """Number of allele to locus pairs in the database, which grows whenever pairs are inserted."""
+    return int(session.from_sql("select count(*) as pairs from pairs;")["pairs"][0])
+
+
+def read_meta(path):
+    meta_file = files.joinpath(path, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as file:
+        return json.load(file)
+
+
+def rebuild(session, path):
+    """Build the index of a database from its pairs, to be called while holding the lock of path."""
+    meta = read_meta(path)
+    count = pair_count(session)
+    query = "select pairs.allele_id, pairs.locus_id, alleles.peptide_seq " \
+            "from pairs inner join alleles " \
+            "on pairs.allele_id = alleles.allele_id;"
+    pairs = session.from_sql(query)
+    loci = session.from_sql("select locus_id, occurrence from loci order by locus_id;")
+    keys, codes = np.empty(0, dtype=HASH_DTYPE), np.empty(0, dtype=LOCUS_DTYPE)
+    version = meta["version"] if meta else 0
+    empty = AlleleIndex(path, version, keys, codes, keys, codes,
+                        loci["locus_id"].tolist(), loci["occurrence"].tolist())
+    return empty.merge(pairs[["allele_id", "locus_id"]], peptide_pairs(pairs["peptide_seq"], pairs["locus_id"]),
+                       count)
+
+
+def build(session):
+    """Build the index of a database unless another process has built an up-to-date one while waiting for the lock."""
+    path = index_dir(session.database)
+    with locked(path):
+        meta = read_meta(path)
+        if meta and meta.get("pairs") == pair_count(session):
+            return AlleleIndex.open(path)
+        return rebuild(session, path)
+
+
+def load(session):
+    """
+    Load the allele index of a database session, building it on first use and reloading it when it is updated.
+    The index is rebuilt when the number of pairs in the database differs from the one it was built from,
+    as pairs may have been added by a worker with another cache.
+    """
+    database = session.database
+    path = index_dir(database)
+    meta_file = files.joinpath(path, "meta.json")
+    with _LOCK:
+        index = _INDEXES.get(database)
+        if os.path.exists(meta_file) and \
+                (not index or index.path != path or os.path.getmtime(meta_file) != index.mtime):
+            index = AlleleIndex.open(path)
+        if not os.path.exists(meta_file) or index.pair_count != pair_count(session):
+            index = build(session)
+        index.mtime = os.path.getmtime(meta_file)
+        _INDEXES[database] = index
+    return index
+
+
+def add_pairs(session, pairs, peptides):
+    """
+    Merge pairs inserted into the database into the index. If the database gained more pairs than those
+    new to the index, pairs were added elsewhere as well and the index is rebuilt instead.
+    """
+    path = index_dir(session.database)
+    if not os.path.exists(files.joinpath(path, "meta.json")):
+        return load(session)
+    with locked(path):
+        current = AlleleIndex.open(path)
+        pairs = pairs.drop_duplicates(["allele_id", "locus_id"])
+        known = current.pairs(pairs["allele_id"].unique())
+        known = set(zip(known["allele_id"], known["locus_id"]))
+        new = sum((x, y) not in known for x, y in zip(pairs["allele_id"], pairs["locus_id"]))
+        count = pair_count(session)
+        if current.pair_count is not None and count == current.pair_count + new:
+            current.merge(pairs, peptides, count)
+        else:
+            rebuild(session, path)
+    return load(session)
+
+
+def invalidate(database):
+    path = index_dir(database)
+    with locked(path):
+        meta_file = files.joinpath(path, "meta.json")
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+    with _LOCK:
+        _INDEXES.pop(database, None)
@@ -1,19 +1,72 @@
+import importlib
 import os
+import threading
 from django.conf import settings
-from pymongo import MongoClient
 
 NOSQLCONFIG = {}
 
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_INDEXED = set()
+
 
 def load_database_config(logger=None):
-    global NOSQLCONFIG
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benga.settings")
-    NOSQLCONFIG["host"] = settings.NOSQLS['mongodb']['HOST']
-    NOSQLCONFIG["port"] = settings.NOSQLS['mongodb']['PORT']
-    logger.info("Database: {}:{}".format(NOSQLCONFIG["host"], NOSQLCONFIG["port"]))
+    config = settings.NOSQLS['mongodb']
+    NOSQLCONFIG["host"] = config['HOST']
+    NOSQLCONFIG["port"] = config['PORT']
+    NOSQLCONFIG["client"] = config.get('CLIENT', "pymongo.MongoClient")
+    NOSQLCONFIG["options"] = dict(config.get('OPTIONS', {}))
+    if logger:
+        logger.info("Database: {}:{}".format(NOSQLCONFIG["host"], NOSQLCONFIG["port"]))
+
+
+def make_client(config):
+    module, name = config["client"].rsplit(".", 1)
+    client_class = getattr(importlib.import_module(module), name)
+    return client_class(config["host"], config["port"], **config["options"])
+
+
+def get_client():
+    """
+    MongoClient from the registry of this process. pymongo clients are not fork-safe, so clients
+    are keyed by pid and a forked worker opens its own pool instead of using the sockets of its parent.
+    """
+    if not NOSQLCONFIG:
+        load_database_config()
+    pid = os.getpid()
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(pid)
+        if client is None:
+            # clients inherited from a parent process are dropped without closing their sockets
+            _CLIENTS.clear()
+            client = _CLIENTS[pid] = make_client(NOSQLCONFIG)
+    return client
+
+
+def reset_after_fork():
+    global _CLIENTS_LOCK
+    _CLIENTS_LOCK = threading.Lock()
+    _CLIENTS.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def collection_epoch(track):
+    """Version of a collection in its database's meta collection, bumped whenever references are loaded."""
+    meta = track.database.meta.find_one({"_id": track.name})
+    return meta["epoch"] if meta else 0
+
+
+def bump_epoch(track):
+    track.database.meta.update_one({"_id": track.name}, {"$inc": {"epoch": 1}}, upsert=True)
 
 
 def get_dbtrack(database):
-    client = MongoClient("localhost", 27017)
-    db = client[database]
+    db = get_client()[database]
+    if database not in _INDEXED:
+        db.track.create_index("BioSample")
+        _INDEXED.add(database)
     return db.track
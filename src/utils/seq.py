@@ -25,7 +25,8 @@ def save_records(seqs, filename):
 
 
 def compile_blastpdb(input_file, output_file):
-    subprocess.run(" ".join(["makeblastdb", "-in", input_file, "-dbtype", "prot", "-out", output_file]), shell=True)
+    subprocess.run(" ".join(["makeblastdb", "-in", input_file, "-dbtype", "prot", "-out", output_file]), shell=True,
+                   check=True)
 
 
 def query_blastpdb(query, db_dir, output_file, cols, threads=2):
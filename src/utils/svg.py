@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+
+
+def attributes(attrs):
+    return "".join(' {}={}'.format(key.replace("_", "-"), quoteattr(str(value))) for key, value in attrs.items())
+
+
+def points(coords):
+    return " ".join("{:.1f},{:.1f}".format(x, y) for x, y in coords)
+
+
+class SVGWriter:
+    """Write SVG elements to a file as they are drawn, without building a document in memory."""
+
+    def __init__(self, file, width, height):
+        self.file = open(file, "w")
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{0:.0f}" height="{1:.0f}" '
+                        'viewBox="0 0 {0:.0f} {1:.0f}">\n'.format(width, height))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def group(self, **attrs):
+        self.file.write("<g{}>\n".format(attributes(attrs)))
+        yield self
+        self.file.write("</g>\n")
+
+    def polyline(self, coords, **attrs):
+        self.file.write('<polyline points="{}"{}/>\n'.format(points(coords), attributes(attrs)))
+
+    def polygon(self, coords, **attrs):
+        self.file.write('<polygon points="{}"{}/>\n'.format(points(coords), attributes(attrs)))
+
+    def text(self, x, y, string, **attrs):
+        self.file.write('<text x="{:.1f}" y="{:.1f}"{}>{}</text>\n'.format(x, y, attributes(attrs), escape(string)))
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write("</svg>\n")
+            self.file.close()
@@ -0,0 +1,29 @@
+import unittest
+
+from src.utils.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_stats(self):
+        cache = LRUCache(1)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        cache.put("b", 2)
+        self.assertEqual(cache.stats(), {"entries": 1, "max_entries": 1, "hits": 1, "misses": 1,
+                                         "evictions": 1, "hit_ratio": 0.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
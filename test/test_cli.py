@@ -1,6 +1,9 @@
 from click.testing import CliRunner
+import tempfile
 import unittest
+from unittest import mock
 from .. import Benga
+from ..src.utils import genecalls
 
 
 class CliTest(unittest.TestCase):
@@ -11,6 +14,23 @@ class CliTest(unittest.TestCase):
         result = self.runner.invoke(Benga.main, ['-h'])
         self.assertEqual(result.exit_code, 0)
 
+    def test_track_load_help(self):
+        result = self.runner.invoke(Benga.main, ['track-load', '-h'])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.object(Benga.genecalls, "cache_dir", return_value=cache_dir):
+            genecalls.put(cache_dir, "a", {"a": ("ATG", "M", "id")})
+            genecalls.put(cache_dir, "b", {"b": ("ATG", "M", "id")})
+            result = self.runner.invoke(Benga.main, ['cache'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("2 entries", result.output)
+            result = self.runner.invoke(Benga.main, ['cache', '--clear'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Removed 2 entries.", result.output)
+            self.assertIn("0 entries", result.output)
+
     def tearDown(self):
         self.runner = None
 
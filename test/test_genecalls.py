@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from subprocess import CalledProcessError
+from unittest import mock
+
+from src.algorithms import profiling
+from src.utils import genecalls
+
+
+class GeneCallCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def put(self, key, mtime):
+        genecalls.put(self.path, key, {key: ("ATG", "M", "id")})
+        os.utime(genecalls.entry_path(self.path, key), (mtime, mtime))
+
+    def test_get_put(self):
+        self.assertIsNone(genecalls.get(self.path, "k"))
+        genecalls.put(self.path, "k", {"a": ("ATG", "M", "id")})
+        self.assertEqual(genecalls.get(self.path, "k"), {"a": ("ATG", "M", "id")})
+        with open(genecalls.entry_path(self.path, "broken"), "wb") as file:
+            file.write(b"not gzip")
+        self.assertIsNone(genecalls.get(self.path, "broken"))
+
+    def test_prune_least_recently_used(self):
+        for i, key in enumerate(["a", "b", "c"]):
+            self.put(key, 1000 + i)
+        genecalls.get(self.path, "a")  # a becomes the most recently used
+        self.assertEqual([key for key, _, _ in genecalls.entries(self.path)], ["a", "c", "b"])
+        size = max(size for _, size, _ in genecalls.entries(self.path))
+        self.assertEqual(genecalls.prune(self.path, 2 * size), ["b"])
+        self.assertEqual(sorted(key for key, _, _ in genecalls.entries(self.path)), ["a", "c"])
+        self.assertEqual(sorted(genecalls.prune(self.path, 0)), ["a", "c"])
+
+    def test_failed_prodigal_is_not_cached(self):
+        fasta = os.path.join(self.path, "genome.fa")
+        with open(fasta, "w") as file:
+            file.write(">contig\nATGAAATAA\n")
+        cache_dir = os.path.join(self.path, "cache")
+        with mock.patch.object(profiling.cmds, "form_prodigal_cmd", return_value="exit 1"):
+            with self.assertRaises(CalledProcessError):
+                profiling.identify_alleles((fasta, self.path, "model", cache_dir))
+        self.assertEqual(genecalls.entries(cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
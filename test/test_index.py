@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from src.algorithms import profiling
+from src.utils import index, operations
+
+
+def allele(name):
+    return operations.make_seqid(name)
+
+
+class FakeSession:
+    """Session answering the queries of the allele index from DataFrames."""
+
+    def __init__(self, database, pairs, peptides, occurrence):
+        self.database = database
+        self.pairs = pd.DataFrame(pairs, columns=["allele_id", "locus_id"])
+        self.peptides = dict(peptides)
+        self.loci = pd.DataFrame(sorted(occurrence.items()), columns=["locus_id", "occurrence"])
+
+    def insert(self, pairs, peptides):
+        self.pairs = pd.concat([self.pairs, pd.DataFrame(pairs, columns=["allele_id", "locus_id"])],
+                               ignore_index=True).drop_duplicates()
+        self.peptides.update(peptides)
+
+    def from_sql(self, query, params=None):
+        if "count(*)" in query:
+            return pd.DataFrame({"pairs": [len(self.pairs)]})
+        if "inner join alleles" in query:
+            pairs = self.pairs.copy()
+            pairs["peptide_seq"] = [self.peptides[x] for x in pairs["allele_id"]]
+            return pairs
+        if "from loci" in query:
+            return self.loci.copy()
+        raise ValueError(query)
+
+
+def profile_by_query(alleles, genome_id, selected_loci, session):
+    """Profile of one genome as the former per-genome query resolved it, with rows in primary key order."""
+    profile = session.pairs[session.pairs["allele_id"].isin(list(alleles)) &
+                            session.pairs["locus_id"].isin(selected_loci)]
+    profile = profile.sort_values(["allele_id", "locus_id"]).drop_duplicates("allele_id")
+    profile = profile.drop_duplicates("locus_id").set_index("locus_id")
+    return profile.rename(columns={"allele_id": genome_id}).iloc[:, 0]
+
+
+class AlleleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(index, "index_dir", lambda database: os.path.join(self.temp_dir.name, database))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp_dir.cleanup)
+        index._INDEXES.clear()
+        # a1 and a2 are synonymous alleles of locus A, the peptide of a3 occurs in loci A and B
+        self.session = FakeSession("db", [(allele("a1"), "A"), (allele("a2"), "A"), (allele("a3"), "A"),
+                                          (allele("b1"), "B"), (allele("b2"), "B"), (allele("c1"), "C")],
+                                   {allele("a1"): "PA", allele("a2"): "PA", allele("a3"): "PX",
+                                    allele("b1"): "PB", allele("b2"): "PX", allele("c1"): "PC"},
+                                   {"A": 100.0, "B": 95.0, "C": 50.0})
+
+    def test_peptide_loci(self):
+        allele_index = index.load(self.session)
+        loci = allele_index.peptide_loci([allele("PA"), allele("PB"), allele("PX"), allele("PZ")])
+        self.assertEqual(list(loci), ["A", "B", None, None])
+
+    def test_select_loci(self):
+        allele_index = index.load(self.session)
+        self.assertEqual(allele_index.select_loci(95), {"A", "B"})
+        self.assertEqual(allele_index.select_loci(100), {"A"})
+
+    def test_pairs(self):
+        self.session.insert([(allele("a1"), "B")], {})
+        allele_index = index.load(self.session)
+        pairs = allele_index.pairs([allele("a1"), allele("c1"), allele("z1")])
+        self.assertEqual(list(zip(pairs["allele_id"], pairs["locus_id"])),
+                         [(allele("a1"), "A"), (allele("a1"), "B"), (allele("c1"), "C")])
+
+    def test_add_pairs(self):
+        old = index.load(self.session)
+        old_alleles = np.array(old.alleles)
+        new_pairs = pd.DataFrame([(allele("a4"), "A"), (allele("d1"), "D")], columns=["allele_id", "locus_id"])
+        self.session.insert(new_pairs.values.tolist(), {allele("a4"): "PY", allele("d1"): "PB"})
+        with mock.patch.object(index, "rebuild", side_effect=AssertionError("rebuilt")):
+            allele_index = index.add_pairs(self.session, new_pairs,
+                                           index.peptide_pairs(["PY", "PB"], new_pairs["locus_id"]))
+        self.assertEqual(allele_index.version, old.version + 1)
+        self.assertTrue(all(allele_index.contains([allele("a4"), allele("d1")])))
+        self.assertEqual(list(allele_index.peptide_loci([allele("PY"), allele("PB")])), ["A", None])
+        # the arrays of the previous version stay readable
+        self.assertTrue(np.array_equal(old.alleles, old_alleles))
+
+    def test_pairs_added_elsewhere(self):
+        index.load(self.session)
+        self.session.insert([(allele("a5"), "A")], {allele("a5"): "PA"})
+        self.assertTrue(index.load(self.session).contains([allele("a5")])[0])
+
+        ours = pd.DataFrame([(allele("a6"), "A")], columns=["allele_id", "locus_id"])
+        self.session.insert([(allele("a7"), "A")] + ours.values.tolist(), {allele("a6"): "PA", allele("a7"): "PA"})
+        allele_index = index.add_pairs(self.session, ours, index.peptide_pairs(["PA"], ours["locus_id"]))
+        self.assertTrue(all(allele_index.contains([allele("a6"), allele("a7")])))
+
+    def test_rebuild_keeps_mapped_arrays(self):
+        old = index.load(self.session)
+        old_alleles = np.array(old.alleles)
+        index.invalidate(self.session.database)
+        self.session.insert([(allele("a0"), "A")], {allele("a0"): "PA"})
+        allele_index = index.load(self.session)
+        self.assertEqual(len(allele_index), len(old) + 1)
+        self.assertTrue(np.array_equal(old.alleles, old_alleles))
+
+    def test_profile_by_batch(self):
+        self.session.insert([(allele("a1"), "B"), (allele("c2"), "C")], {allele("c2"): "PC"})
+        allele_index = index.load(self.session)
+        # two alleles of locus A, listed against the order of their hashes
+        a_alleles = sorted(["a1", "a2"], key=allele, reverse=True)
+        genomes = [("g1", {allele(x): None for x in a_alleles + ["b2", "c1", "z1"]}),
+                   ("g2", {allele(x): None for x in ["a3", "c2", "b1"]}),
+                   ("g3", {allele("z2"): None})]
+        selected = {"A", "B", "C"}
+        profiles = profiling.profile_by_batch(genomes, selected, allele_index)
+        self.assertEqual(list(profiles.columns), ["g1", "g2", "g3"])
+        for genome_id, alleles in genomes:
+            expected = profile_by_query(alleles, genome_id, selected, self.session)
+            self.assertEqual(profiles[genome_id].dropna().sort_index().to_dict(), expected.sort_index().to_dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
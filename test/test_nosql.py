@@ -0,0 +1,63 @@
+import os
+import unittest
+
+from src.utils import nosql
+
+
+class FakeCollection:
+    def __init__(self):
+        self.indexes = []
+
+    def create_index(self, key):
+        self.indexes.append(key)
+
+
+class FakeClient:
+    def __init__(self, host, port, **options):
+        self.address = (host, port)
+        self.options = options
+        self.databases = {}
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, type("Database", (), {"track": FakeCollection()})())
+
+
+class ClientRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(nosql.NOSQLCONFIG)
+        nosql.NOSQLCONFIG.update({"host": "mongo", "port": 27017, "client": __name__ + ".FakeClient",
+                                  "options": {"maxPoolSize": 5}})
+        nosql.reset_after_fork()
+        nosql._INDEXED.clear()
+
+    def tearDown(self):
+        nosql.NOSQLCONFIG.clear()
+        nosql.NOSQLCONFIG.update(self.config)
+        nosql.reset_after_fork()
+        nosql._INDEXED.clear()
+
+    def test_client_is_shared(self):
+        client = nosql.get_client()
+        self.assertIsInstance(client, FakeClient)
+        self.assertEqual(client.address, ("mongo", 27017))
+        self.assertEqual(client.options, {"maxPoolSize": 5})
+        self.assertIs(nosql.get_client(), client)
+
+    def test_index_is_ensured_once(self):
+        track = nosql.get_dbtrack("references")
+        self.assertIs(nosql.get_dbtrack("references"), track)
+        self.assertEqual(track.indexes, ["BioSample"])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_forked_process_opens_its_own_client(self):
+        client = nosql.get_client()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            os.write(write, b"1" if nosql.get_client() is not client else b"0")
+            os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        with os.fdopen(read, "rb") as file:
+            self.assertEqual(file.read(), b"1")
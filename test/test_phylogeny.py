@@ -0,0 +1,243 @@
+import io
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+import fastcluster
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+from src.algorithms import distances, phylogeny, store
+
+
+def random_profiles(n_loci, n_genomes, seed=0):
+    rng = np.random.RandomState(seed)
+    alleles = rng.randint(1, 5, (n_loci, n_genomes)).astype(str).astype(object)
+    alleles[rng.rand(n_loci, n_genomes) < 0.1] = np.nan
+    return pd.DataFrame(alleles, index=["locus_{}".format(i) for i in range(n_loci)],
+                        columns=["genome_{}".format(j) for j in range(n_genomes)])
+
+
+def naive_distances(profiles):
+    values = profiles.fillna("0").values.T
+    return np.array([[np.sum(x != y) for y in values] for x in values])
+
+
+def recursive_newick(node, newick, parentdist, leaf_names):
+    if node.is_leaf():
+        return "{}:{:.2f}{}".format(leaf_names[node.id], parentdist - node.dist, newick)
+    newick = "):{:.2f}{}".format(parentdist - node.dist, newick) if newick else ");"
+    newick = recursive_newick(node.get_left(), newick, node.dist, leaf_names)
+    newick = recursive_newick(node.get_right(), ",{}".format(newick), node.dist, leaf_names)
+    return "({}".format(newick)
+
+
+class DistancesTest(unittest.TestCase):
+    def setUp(self):
+        self.profiles = random_profiles(40, 25)
+
+    def test_encode_profiles(self):
+        codes = distances.encode_profiles(self.profiles)
+        self.assertEqual(codes.shape, (25, 40))
+        self.assertTrue(np.array_equal(codes.T == distances.MISSING, self.profiles.isnull().values))
+
+    def test_condensed_distances(self):
+        codes = distances.encode_profiles(self.profiles)
+        expected = naive_distances(self.profiles)
+        self.assertTrue(np.array_equal(squareform(distances.condensed_distances(codes)), expected))
+
+    def test_blocked_distances(self):
+        codes = distances.encode_profiles(self.profiles)
+        block_elements = distances.BLOCK_ELEMENTS
+        distances.BLOCK_ELEMENTS = 1
+        try:
+            blocked = distances.condensed_distances(codes)
+        finally:
+            distances.BLOCK_ELEMENTS = block_elements
+        self.assertTrue(np.array_equal(blocked, distances.condensed_distances(codes)))
+
+    def test_mmap_distances(self):
+        codes = distances.encode_profiles(self.profiles)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            condensed = distances.condensed_distances_mmap(codes, temp_dir + "/distances.npy", processes=2)
+            self.assertTrue(np.array_equal(condensed, distances.condensed_distances(codes)))
+            condensed = distances.condensed_distances_mmap(codes, temp_dir + "/threads.npy", processes=2,
+                                                           executor="thread")
+            self.assertTrue(np.array_equal(condensed, distances.condensed_distances(codes)))
+
+    def test_mmap_distances_in_daemon(self):
+        # as in a Celery prefork worker, which may not start child processes
+        codes = distances.encode_profiles(self.profiles)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = temp_dir + "/distances.npy"
+            worker = multiprocessing.get_context("fork").Process(
+                target=distances.condensed_distances_mmap, args=(codes, filename, 2), daemon=True)
+            worker.start()
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+            self.assertTrue(np.array_equal(np.load(filename), distances.condensed_distances(codes)))
+
+    def test_single_linkage(self):
+        condensed = distances.condensed_distances(distances.encode_profiles(self.profiles))
+        linkage = distances.single_linkage(condensed, 25)
+        self.assertTrue(hierarchy.is_valid_linkage(linkage))
+        self.assertTrue(np.array_equal(hierarchy.cophenet(linkage), hierarchy.cophenet(fastcluster.single(condensed))))
+
+
+class DendrogramTest(unittest.TestCase):
+    def test_make_tree(self):
+        profiles = random_profiles(40, 25)
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(profiles)
+        self.assertEqual(dendro._linkage.shape, (24, 4))
+        self.assertEqual(dendro._tree.count, 25)
+
+    def test_make_tree_mst(self):
+        profiles = random_profiles(40, 25)
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(profiles)
+        mst_dendro = phylogeny.Dendrogram()
+        mst_dendro.make_tree(profiles, method="mst")
+        self.assertTrue(np.array_equal(hierarchy.cophenet(mst_dendro._linkage), hierarchy.cophenet(dendro._linkage)))
+        self.assertEqual(sum(d for _, _, d in mst_dendro.mst), dendro._linkage[:, 2].sum())
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mst_dendro.mst_to_json(os.path.join(temp_dir, "mst.json"))
+            with open(os.path.join(temp_dir, "mst.json")) as file:
+                data = json.load(file)
+        self.assertEqual(len(data["nodes"]), 25)
+        self.assertEqual(len(data["links"]), 24)
+
+    def test_write_newick(self):
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(random_profiles(40, 25))
+        self.assertEqual(dendro.newick, recursive_newick(dendro._tree, "", dendro._tree.dist, dendro._nodes))
+        self.assertEqual(len(dendro.ete_tree), 25)
+
+    def test_write_deep_newick(self):
+        n = 5000
+        linkage = np.array([[0 if i == 0 else n + i - 1, i + 1, i + 1, i + 2] for i in range(n - 1)], dtype=float)
+        buffer = io.StringIO()
+        phylogeny.write_newick(hierarchy.to_tree(linkage), buffer, list(range(n)), precision=0)
+        self.assertTrue(buffer.getvalue().startswith("(4999:4999,(4998:4998,"))
+        self.assertTrue(buffer.getvalue().endswith("(1:1,0:1)" + ":1)" * (n - 2) + ";"))
+
+    def test_export(self):
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(random_profiles(40, 25))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filenames = dendro.export(os.path.join(temp_dir, "tree"))
+            self.assertEqual(set(filenames), set(phylogeny.EXPORT_FORMATS))
+            self.assertTrue(all(os.path.getsize(x) > 0 for x in filenames.values()))
+            with open(filenames["emf"], "rb") as file:
+                data = file.read()
+        record_type, _ = struct.unpack_from("<2I", data)
+        signature, _, size, n_records = struct.unpack_from("<4I", data, 40)
+        self.assertEqual((record_type, signature, size), (1, 0x464D4520, len(data)))
+        position = 0
+        for _ in range(n_records):
+            position += struct.unpack_from("<2I", data, position)[1]
+        self.assertEqual(position, len(data))
+
+    def test_collapsed_layout(self):
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(random_profiles(40, 25))
+        layout = phylogeny.collapsed_layout(dendro._tree, dendro._nodes)
+        expected = hierarchy.dendrogram(dendro._linkage, labels=dendro._nodes, no_plot=True)
+        self.assertEqual(layout["ivl"], expected["ivl"])
+        self.assertEqual(sorted(map(tuple, layout["dcoord"])), sorted(map(tuple, expected["dcoord"])))
+        threshold = np.median(dendro._linkage[:, 2])
+        collapsed = phylogeny.collapsed_layout(dendro._tree, dendro._nodes, threshold)
+        self.assertEqual(len(collapsed["ivl"]) - len(collapsed["triangles"]) + sum(x[2] for x in collapsed["triangles"]), 25)
+        self.assertTrue(all(x[1] <= threshold for x in collapsed["triangles"]))
+
+    def test_export_large(self):
+        dendro = phylogeny.Dendrogram()
+        dendro.make_tree(random_profiles(40, 25))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filenames = dendro.export(os.path.join(temp_dir, "tree"), collapse=np.median(dendro._linkage[:, 2]))
+            root = ET.parse(filenames["svg"]).getroot()
+        self.assertTrue(root.tag.endswith("svg"))
+        self.assertTrue(any(x.tag.endswith("polygon") for x in root.iter()))
+
+    def test_make_tree_low_memory(self):
+        profiles = random_profiles(40, 25)
+        dendro = phylogeny.Dendrogram()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dendro.make_tree(profiles, workdir=temp_dir, processes=2)
+        self.assertEqual(dendro._tree.count, 25)
+
+
+class ProfileStoreTest(unittest.TestCase):
+    def test_store_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(store, "settings", SimpleNamespace(CACHE_ROOT=temp_dir)):
+            root = os.path.realpath(os.path.join(temp_dir, "profile_store"))
+            self.assertEqual(store.store_dir("vibrio_2019-a"), os.path.join(root, "vibrio_2019-a"))
+            for collection in ["../x", "/etc/x", "a/b", "..", "", None]:
+                with self.assertRaises(ValueError):
+                    store.store_dir(collection)
+            os.makedirs(root, exist_ok=True)
+            os.symlink(temp_dir, os.path.join(root, "link"))
+            with self.assertRaises(ValueError):
+                store.store_dir("link")
+
+    def test_add(self):
+        profiles = random_profiles(40, 30)
+        expected = hierarchy.cophenet(fastcluster.single(distances.condensed_distances(distances.encode_profiles(profiles))))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_store = store.ProfileStore(temp_dir)
+            self.assertEqual(len(profile_store.add(profiles.iloc[:, :20])), 20)
+            self.assertEqual(len(profile_store.add(profiles.iloc[:, 15:])), 10)
+            profile_store = store.ProfileStore(temp_dir)
+            self.assertEqual(profile_store.genomes, list(profiles.columns))
+            lower = profile_store.distances()
+            square = naive_distances(profiles)
+            for j in range(30):
+                self.assertTrue(np.array_equal(lower[distances.lower_index(j):distances.lower_index(j) + j], square[j, :j]))
+            dendro = profile_store.dendrogram()
+        self.assertTrue(np.array_equal(hierarchy.cophenet(dendro._linkage), expected))
+
+    def test_add_loci(self):
+        profiles = random_profiles(40, 30)
+        profiles.iloc[30:, :20] = np.nan
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_store = store.ProfileStore(temp_dir)
+            profile_store.add(profiles.iloc[:30, :20])
+            profile_store.add(profiles.iloc[::-1, 20:])
+            profile_store = store.ProfileStore(temp_dir)
+            self.assertEqual(sorted(profile_store.loci), sorted(profiles.index))
+            self.assertEqual(sorted(x for x in os.listdir(temp_dir) if x.startswith("codes.")), [profile_store.codes_file])
+            lower = profile_store.distances()
+            square = naive_distances(profiles)
+            for j in range(30):
+                self.assertTrue(np.array_equal(lower[distances.lower_index(j):distances.lower_index(j) + j], square[j, :j]))
+
+    def test_add_conflicts(self):
+        profiles = random_profiles(40, 30)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_store = store.ProfileStore(temp_dir)
+            profile_store.add(profiles.iloc[:, :20], scheme="vibrio:95")
+            with self.assertRaises(ValueError):
+                profile_store.add(profiles.iloc[:, 20:], scheme="salmonella:95")
+            self.assertEqual(profile_store.add(profiles.iloc[:, :5], scheme="vibrio:95"), [])
+            changed = profiles.iloc[:, 15:].copy()
+            changed.iloc[0, 0] = "5"
+            with self.assertRaises(ValueError):
+                profile_store.add(changed)
+            with self.assertRaises(ValueError):
+                profile_store.add(pd.concat([changed.iloc[:, 10:], profiles.iloc[:, 25:].replace("1", "2")], axis=1))
+            self.assertEqual(len(store.ProfileStore(temp_dir)), 20)
+            self.assertEqual(len(profile_store.add(profiles.iloc[:, 15:])), 10)
+            self.assertEqual(store.ProfileStore(temp_dir).scheme, "vibrio:95")
+
+
+if __name__ == '__main__':
+    unittest.main()
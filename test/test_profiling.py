@@ -0,0 +1,73 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+
+from src.algorithms import profiling
+
+
+class RefSession:
+    def __init__(self, refs):
+        self.database = "vibrio"
+        self.refs = refs
+
+    def from_sql(self, query, params=None):
+        return pd.DataFrame(self.refs, columns=["locus_id", "ref_allele"])
+
+
+def fake_makeblastdb(ref_db_file, session):
+    with open(ref_db_file + ".pin", "w") as file:
+        file.write("pin")
+    return {locus: 10 for locus, _ in session.refs}
+
+
+def failed_makeblastdb(ref_db_file, session):
+    raise subprocess.CalledProcessError(127, "makeblastdb")
+
+
+class RefBlastpdbTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.settings = mock.patch.object(profiling, "settings", SimpleNamespace(CACHE_ROOT=self.temp_dir.name))
+        self.settings.start()
+        self.cache_dir = os.path.join(self.temp_dir.name, "ref_blastpdb", "vibrio")
+
+    def tearDown(self):
+        self.settings.stop()
+        self.temp_dir.cleanup()
+
+    def test_failed_build_is_not_cached(self):
+        session = RefSession([("a", "x")])
+        with mock.patch.object(profiling, "make_ref_blastpdb", failed_makeblastdb):
+            with self.assertRaises(subprocess.CalledProcessError):
+                profiling.cached_ref_blastpdb(session)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        with mock.patch.object(profiling, "make_ref_blastpdb", fake_makeblastdb):
+            ref_db, ref_len = profiling.cached_ref_blastpdb(session)
+        self.assertTrue(os.path.exists(ref_db + ".pin"))
+        self.assertEqual(ref_len, {"a": 10})
+
+    def test_incomplete_entry_is_rebuilt(self):
+        session = RefSession([("a", "x")])
+        with mock.patch.object(profiling, "make_ref_blastpdb", fake_makeblastdb):
+            ref_db, _ = profiling.cached_ref_blastpdb(session)
+            os.remove(ref_db + ".pin")
+            ref_db, _ = profiling.cached_ref_blastpdb(session)
+        self.assertTrue(os.path.exists(ref_db + ".pin"))
+
+    def test_previous_digests_are_pruned(self):
+        with mock.patch.object(profiling, "make_ref_blastpdb", fake_makeblastdb):
+            old_db, _ = profiling.cached_ref_blastpdb(RefSession([("a", "x")]))
+            building = os.path.join(self.cache_dir, "digest.build")
+            os.makedirs(building)
+            new_db, _ = profiling.cached_ref_blastpdb(RefSession([("a", "y")]))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([os.path.basename(os.path.dirname(new_db)), "digest.build"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
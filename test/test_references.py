@@ -0,0 +1,64 @@
+import importlib.util
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.algorithms import references, search
+from .test_search import random_documents
+
+HAS_MONGOMOCK = importlib.util.find_spec("mongomock") is not None
+
+
+@unittest.skipUnless(HAS_MONGOMOCK, "requires mongomock")
+class ReferenceLoaderTest(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+        self.track = mongomock.MongoClient().db.track
+        self.documents = random_documents(120, 30)
+
+    def profiles(self, documents):
+        return pd.DataFrame({x["BioSample"]: pd.Series(x["profile"], dtype=object) for x in documents})
+
+    def test_packed_and_legacy_documents(self):
+        legacy = self.documents[:40]
+        self.track.insert_many([dict(x) for x in legacy])
+        references.load_references(self.track, [self.profiles(self.documents[40:80])], batch_size=16)
+        count = references.load_references(self.track, [self.profiles(self.documents[60:])], batch_size=16)
+        self.assertEqual(count, 40)
+        self.assertEqual(self.track.count_documents({}), 120)
+        self.assertEqual(self.track.database.meta.find_one({"_id": "track"})["epoch"], 2)
+
+        index = search.ProfileIndex.build(self.track)
+        expected = search.ProfileIndex.from_documents(self.documents)
+        query = pd.Series(self.documents[70]["profile"], dtype=object)
+        query["locus_99"] = "1"
+        self.assertEqual(list(index.samples), list(expected.samples))
+        self.assertTrue(np.array_equal(index.distances(query), expected.distances(query)))
+
+    def test_concurrent_loaders(self):
+        import pymongo.errors
+        first = references.ReferenceLoader(self.track)
+        second = references.ReferenceLoader(self.track)
+        first.load(self.profiles(self.documents[:40]))
+        with self.assertRaises(pymongo.errors.PyMongoError):
+            second.load(self.profiles(self.documents[40:80]))
+
+    def test_locus_without_alleles(self):
+        first = pd.DataFrame({"SAMN1": ["a", np.nan]}, index=["L1", "L2"], dtype=object)
+        second = pd.DataFrame({"SAMN2": ["a", "x"]}, index=["L1", "L2"], dtype=object)
+        references.load_references(self.track, [first])
+        references.load_references(self.track, [second])
+        self.assertEqual(search.load_dictionary(self.track), (["L1", "L2"], [["a"], ["x"]]))
+        index = search.ProfileIndex.build(self.track)
+        self.assertEqual(list(index.distances(second["SAMN2"])), [1, 0])
+
+    def test_dictionary_gap(self):
+        references.load_references(self.track, [self.profiles(self.documents[:40])])
+        search.dictionary_collection(self.track).delete_many({"column": 3})
+        with self.assertRaises(ValueError):
+            search.load_dictionary(self.track)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from src.algorithms import search
+
+
+def random_documents(n_samples, n_loci, seed=0):
+    rng = np.random.RandomState(seed)
+    documents = []
+    for i in range(n_samples):
+        profile = {"locus_{}".format(j): str(rng.randint(1, 4)) for j in range(n_loci) if rng.rand() > 0.05}
+        for locus in rng.choice(list(profile), 2):
+            profile[locus] = None
+        documents.append({"BioSample": "SAMN{}".format(i), "profile": profile})
+    return documents
+
+
+def naive_distances(query_profile, documents):
+    distances = pd.Series(dtype=int)
+    df = pd.DataFrame()
+    df["query_profile"] = query_profile
+    for document in documents:
+        df["ref_profile"] = pd.Series(data=document["profile"], dtype=object)
+        distances.at[document["BioSample"]] = Counter(df["query_profile"] == df["ref_profile"])[False]
+    return distances
+
+
+class ProfileIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.documents = random_documents(200, 30)
+        self.query = pd.Series({"locus_{}".format(j): str(j % 4) for j in range(35)}, dtype=object)
+        self.query["locus_3"] = np.nan
+
+    def test_distances(self):
+        chunk_documents = search.CHUNK_DOCUMENTS
+        search.CHUNK_DOCUMENTS = 64
+        try:
+            index = search.ProfileIndex.from_documents(self.documents)
+        finally:
+            search.CHUNK_DOCUMENTS = chunk_documents
+        expected = naive_distances(self.query, self.documents)
+        self.assertTrue(np.array_equal(index.distances(self.query), expected.values))
+
+    def test_nearest(self):
+        index = search.ProfileIndex.from_documents(self.documents)
+        nearest = index.nearest(self.query, top_n=10)
+        expected = naive_distances(self.query, self.documents).sort_values(kind="stable")[:10]
+        self.assertEqual(list(nearest.values), list(expected.values))
+        self.assertEqual(list(nearest.index), list(expected.index))
+
+    def test_tree_search(self):
+        index = search.ProfileIndex.from_documents(self.documents)
+        tree = search.VPTree(index.codes, leaf_size=4)
+        counts = index.distances(self.query)
+        order = np.lexsort((np.arange(len(counts)), counts))
+        for top_n, cutoff in [(1, None), (10, None), (300, None), (10, 25), (50, 22)]:
+            expected = order[:top_n]
+            if cutoff is not None:
+                expected = expected[counts[expected] <= cutoff]
+            dist, positions = tree.search(*index.encode(self.query), top_n=top_n, cutoff=cutoff)
+            self.assertEqual(list(positions), list(expected))
+            self.assertEqual(list(dist), list(counts[expected]))
+
+    def test_batch_nearest(self):
+        index = search.ProfileIndex.from_documents(self.documents)
+        queries = pd.DataFrame({"query_{}".format(k): self.query.shift(k) for k in range(4)})
+        queries.loc["locus_99"] = "1"
+        block = index.distance_block(queries)
+        nearest = index.batch_nearest(queries, top_n=10, cutoff=25)
+        for k, query in enumerate(queries.columns):
+            self.assertEqual(list(block[k]), list(naive_distances(queries[query], self.documents).values))
+            self.assertTrue(nearest[query].equals(index.nearest(queries[query], top_n=10, cutoff=25)))
+
+    def test_batch_nearest_tree(self):
+        documents = random_documents(search.TREE_MIN_SAMPLES + 500, 30, seed=1)
+        index = search.ProfileIndex.from_documents(documents)
+        queries = pd.DataFrame({x["BioSample"]: pd.Series(x["profile"], dtype=object) for x in documents[:10]})
+        nearest = index.batch_nearest(queries, top_n=50)
+        for query in queries.columns:
+            counts = index.distances(queries[query])
+            expected = np.lexsort((np.arange(len(counts)), counts))[:50]
+            self.assertEqual(list(nearest[query].index), list(index.samples[expected]))
+            self.assertTrue(nearest[query].equals(index.nearest(queries[query], top_n=50)))
+
+    def test_top_ties(self):
+        index = search.ProfileIndex.from_documents(self.documents)
+        counts = np.random.RandomState(0).randint(0, 3, len(self.documents))
+        for top_n, cutoff in [(1, None), (50, None), (150, 1), (500, None)]:
+            expected = np.lexsort((np.arange(len(counts)), counts))[:top_n]
+            if cutoff is not None:
+                expected = expected[counts[expected] <= cutoff]
+            top = index.top(counts, top_n, cutoff)
+            self.assertEqual(list(top.index), list(index.samples[expected]))
+            self.assertEqual(list(top.values), list(counts[expected]))
+
+    def test_pairwise_distances(self):
+        profiles = pd.DataFrame({"a": ["1", np.nan, "3"], "b": ["1", np.nan, "2"], "c": ["2", "3", "3"]})
+        expected = [[0, 2, 2], [2, 0, 3], [2, 3, 0]]
+        self.assertEqual(search.pairwise_distances(profiles).values.tolist(), expected)
+
+    def test_pairwise_distances_as_references(self):
+        documents = self.documents[:20]
+        queries = pd.DataFrame({x["BioSample"]: x["profile"] for x in documents})
+        block = search.ProfileIndex.from_documents(documents).distance_block(queries)
+        np.fill_diagonal(block, 0)
+        self.assertEqual(search.pairwise_distances(queries).values.tolist(), block.tolist())
+
+    def test_profile_key(self):
+        shuffled = self.query.sample(frac=1, random_state=0)
+        self.assertEqual(search.profile_key(shuffled), search.profile_key(self.query))
+        self.assertNotEqual(search.profile_key(self.query.drop("locus_3")), search.profile_key(self.query))
+        changed = self.query.copy()
+        changed["locus_1"] = "2"
+        self.assertNotEqual(search.profile_key(changed), search.profile_key(self.query))
+
+
+if __name__ == '__main__':
+    unittest.main()
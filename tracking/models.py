@@ -10,6 +10,14 @@ def result_path(instance, filename):
     return "tracked_results/{0}/{1}".format(instance.id, filename)
 
 
+def batch_sequences_path(instance, filename):
+    return "tracking/{0}/{1}".format(instance.batch_id.id, instance.file.name)
+
+
+def batch_result_path(instance, filename):
+    return "tracked_results/{0}/{1}".format(instance.id.id, filename)
+
+
 class Sequence(models.Model):
     id = models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, null=False, auto_created=True)
     created = models.DateTimeField(auto_now_add=True)
@@ -31,3 +39,25 @@ class Tracking(models.Model):
     id = models.OneToOneField(Sequence, on_delete=models.CASCADE, primary_key=True)
     allele_db = models.CharField(max_length=100, choices=ALLELE_DB_CHOICES, null=False)
     profile_db = models.CharField(max_length=100, choices=PROFILE_DB_CHOICES, null=False)
+
+
+class Batch(models.Model):
+    id = models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, null=False, auto_created=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class BatchSequence(models.Model):
+    id = models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, null=False, auto_created=True)
+    batch_id = models.ForeignKey(Batch, on_delete=models.CASCADE)
+    file = models.FileField(upload_to=batch_sequences_path, null=False)
+
+
+class BatchTrackedResults(models.Model):
+    id = models.OneToOneField(Batch, on_delete=models.CASCADE, primary_key=True)
+    json = models.FileField(upload_to=batch_result_path, null=False, max_length=250)
+
+
+class BatchTracking(models.Model):
+    id = models.OneToOneField(Batch, on_delete=models.CASCADE, primary_key=True)
+    allele_db = models.CharField(max_length=100, choices=Tracking.ALLELE_DB_CHOICES, null=False)
+    profile_db = models.CharField(max_length=100, choices=Tracking.PROFILE_DB_CHOICES, null=False)
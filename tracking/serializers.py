@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from tracking.models import Sequence, TrackedResults, Tracking
+from tracking.models import Sequence, TrackedResults, Tracking, Batch, BatchSequence, BatchTrackedResults,\
+    BatchTracking
 
 
 class SequenceSerializer(serializers.ModelSerializer):
@@ -18,3 +19,27 @@ class TrackingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tracking
         fields = ('id', 'allele_db', 'profile_db')
+
+
+class BatchSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Batch
+        fields = ('id', 'created')
+
+
+class BatchSequenceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BatchSequence
+        fields = ('id', 'batch_id', 'file')
+
+
+class BatchTrackedResultsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BatchTrackedResults
+        fields = ('id', 'json')
+
+
+class BatchTrackingSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BatchTracking
+        fields = ('id', 'allele_db', 'profile_db')
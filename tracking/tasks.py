@@ -1,37 +1,55 @@
 import os
 import json
-from collections import Counter
 from celery import shared_task
 import pandas as pd
 from django.conf import settings
 from django.core.files import File
 from src.utils import nosql
-from src.algorithms import profiling
-from src.utils import files
-from tracking.serializers import TrackedResultsSerializer
+from src.algorithms import profiling, search
+from src.utils import cache, files
+from tracking.serializers import TrackedResultsSerializer, BatchTrackedResultsSerializer
 
+METADATA_PROJECTION = {"profile": 0, "codes": 0, "code_dtype": 0, "_id": 0}
 
-def distance_against_all(query_profile, track):
-    distances = pd.Series()
-    df = pd.DataFrame()
-    df["query_profile"] = query_profile
-    for profile in track.find():
-        df["ref_profile"] = pd.Series(data=profile["profile"])
-        distances.at[profile['BioSample']] = Counter(df["query_profile"] == df["ref_profile"])[0]
-    return distances
+RESULTS = cache.LRUCache(settings.TRACKING_CACHE_ENTRIES)
 
 
-def add_metadata(distances, track, top_n=100):
-    results = pd.DataFrame()
-    results['distance'] = distances.sort_values()[0:top_n]
-    for sample in results.index:
-        metadata = track.find_one({'BioSample': sample})
-        for col in metadata:
-            if col != "profile" and col != "_id":
-                results.loc[sample, col] = metadata[col]
+def nearest_profiles(query_profile, track, top_n=100, cutoff=None):
+    return search.load(track).nearest(query_profile, top_n, cutoff)
+
+
+def result_key(query_profile, track, version, top_n, cutoff):
+    return search.profile_key(query_profile), track.database.name, track.name, version, top_n, cutoff
+
+
+def collection_version(track):
+    """
+    Epoch of a collection with its signature, so cached results expire when references are loaded
+    and also when documents are inserted without bumping the epoch.
+    """
+    return nosql.collection_epoch(track), search.collection_signature(track)
+
+
+def find_metadata(samples, track):
+    documents = track.find({"BioSample": {"$in": list(samples)}}, METADATA_PROJECTION)
+    metadata = pd.DataFrame(list(documents))
+    if not metadata.empty:
+        metadata = metadata.drop_duplicates("BioSample").set_index("BioSample", drop=False)
+    return metadata
+
+
+def join_metadata(distances, metadata):
+    results = pd.DataFrame({"distance": distances})
+    if not metadata.empty:
+        results = results.join(metadata)
     return results
 
 
+def add_metadata(distances, track, top_n=100):
+    distances = distances.sort_values(kind="stable")[0:top_n]
+    return join_metadata(distances, find_metadata(distances.index, track))
+
+
 def to_db(id, results_file):
     results = {"id": id, "json": File(open(results_file, "rb"))}
     serializer = TrackedResultsSerializer(data=results)
@@ -41,12 +59,62 @@ def to_db(id, results_file):
         print(serializer.errors)
 
 
+def batch_to_db(batch_id, results_file):
+    results = {"id": batch_id, "json": File(open(results_file, "rb"))}
+    serializer = BatchTrackedResultsSerializer(data=results)
+    if serializer.is_valid():
+        serializer.save()
+    else:
+        print(serializer.errors)
+
+
+def track_profile(query_profile, track, top_n=100, cutoff=None):
+    """Nearest references with metadata of a query profile, cached while the collection is unchanged."""
+    key = result_key(query_profile, track, collection_version(track), top_n, cutoff)
+    results = RESULTS.get(key)
+    if results is None:
+        distances = nearest_profiles(query_profile, track, top_n, cutoff)
+        results = add_metadata(distances, track, top_n)
+        RESULTS.put(key, results)
+    return results.copy()
+
+
+def track_batch(query_profiles, track, top_n=100, cutoff=None):
+    """
+    Nearest references with metadata of each query of a locus x genome table, and the query x query distances.
+    Queries with cached results are left out of the distance block.
+    """
+    version = collection_version(track)
+    keys = {query: result_key(query_profiles[query], track, version, top_n, cutoff) for query in query_profiles.columns}
+    tracked = {}
+    for query, key in keys.items():
+        results = RESULTS.get(key)
+        if results is not None:
+            tracked[query] = results
+    missing = [query for query in query_profiles.columns if query not in tracked]
+    if missing:
+        nearest = search.load(track).batch_nearest(query_profiles[missing], top_n, cutoff)
+        samples = set(sample for distances in nearest.values() for sample in distances.index)
+        metadata = find_metadata(samples, track)
+        for query, distances in nearest.items():
+            tracked[query] = join_metadata(distances, metadata)
+            RESULTS.put(keys[query], tracked[query])
+    results = {query: tracked[query].to_dict('records') for query in query_profiles.columns}
+    query_distances = search.pairwise_distances(query_profiles)
+    return {"results": results,
+            "query_distances": {"genomes": list(query_distances.index), "matrix": query_distances.values.tolist()}}
+
+
 @shared_task
-def track(query_profile, database):
+def track(query_profile, database, top_n=100, cutoff=None):
     track = nosql.get_dbtrack(database)
-    distances = distance_against_all(query_profile, track)
-    results = add_metadata(distances, track)
-    return results
+    return track_profile(query_profile, track, top_n, cutoff)
+
+
+@shared_task
+def cache_stats():
+    """Size and hit ratio of the tracking result cache of the worker running this task."""
+    return RESULTS.stats()
 
 
 @shared_task
@@ -61,11 +129,30 @@ def profile_and_track(id, allele_db, occr_level, profile_db):
     query_profile = pd.read_csv(profile_filename, sep="\t", index_col=0)
     query_profile = query_profile[query_profile.columns[0]]
     track = nosql.get_dbtrack(profile_db)
-    distances = distance_against_all(query_profile, track)
-    results = add_metadata(distances, track)
+    results = track_profile(query_profile, track)
 
     results_file = os.path.join(output_dir, id[0:8] + ".json")
     with open(results_file, "w") as file:
         json_content = json.dumps(results.to_dict('records'))
         file.write(json_content)
     to_db(id, results_file)
+
+
+@shared_task
+def profile_and_track_batch(batch_id, allele_db, occr_level, profile_db, top_n=100, cutoff=None):
+    input_dir = os.path.join(settings.MEDIA_ROOT, "tracking", batch_id)
+    output_dir = os.path.join(settings.MEDIA_ROOT, "temp", batch_id)
+    files.create_if_not_exist(output_dir)
+
+    profile_filename = os.path.join(output_dir, "profile.tsv")
+    profiling.profiling(output_dir, input_dir, allele_db, occr_level=occr_level, threads=2)
+
+    query_profiles = pd.read_csv(profile_filename, sep="\t", index_col=0)
+    track = nosql.get_dbtrack(profile_db)
+    results = track_batch(query_profiles, track, top_n, cutoff)
+
+    results_file = os.path.join(output_dir, batch_id[0:8] + ".json")
+    with open(results_file, "w") as file:
+        json_content = json.dumps(results)
+        file.write(json_content)
+    batch_to_db(batch_id, results_file)
@@ -54,3 +54,26 @@ class TrackedResultsTests(APITestCase):
         self.assertEqual(response.data.keys(), {"id", "json"},
                          "Recieved object does not contain 'id' and 'json' field.")
         self.assertEqual(str(response.data["id"]), self.seqid, "Inconsistent in 'id' field.")
+
+
+class BatchTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.client = None
+
+    def test_create_batch_seq(self):
+        """
+        Ensure we can add a Sequence to a new tracking Batch.
+        """
+        response = self.client.post(reverse("batch-list"), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        batch_id = response.data["id"]
+        url = reverse("batch-sequence-list")
+        test_file = os.path.join(TESTDATA_ROOT, "vibrio_n16961.fasta")
+        with open(test_file, "rb") as file:
+            response = self.client.post(url, {"batch_id": batch_id, "file": file})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data.keys(), {"id", "batch_id", "file"},
+                         "Recieved object does not contain 'id', 'batch_id' and 'file' field.")
@@ -8,4 +8,10 @@ urlpatterns = [
     path('results/', views.TrackedResultsList.as_view(), name="results-list"),
     path('results/<uuid:pk>/', views.TrackedResultsDetail.as_view(), name="results-detail"),
     path('tracking/', views.Tracking.as_view(), name="tracking"),
+    path('batch/', views.BatchList.as_view(), name="batch-list"),
+    path('batch/<uuid:pk>/', views.BatchDetail.as_view(), name="batch-detail"),
+    path('batch-sequence/', views.BatchSequenceList.as_view(), name="batch-sequence-list"),
+    path('batch-results/', views.BatchTrackedResultsList.as_view(), name="batch-results-list"),
+    path('batch-results/<uuid:pk>/', views.BatchTrackedResultsDetail.as_view(), name="batch-results-detail"),
+    path('batch-tracking/', views.BatchTracking.as_view(), name="batch-tracking"),
 ]
@@ -1,12 +1,13 @@
-from rest_framework import generics
+from rest_framework import mixins, generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.http import Http404
 from tracking.serializers import SequenceSerializer, TrackedResultsSerializer,\
-    TrackingSerializer
-from tracking.tasks import profile_and_track
-from tracking.models import Sequence, TrackedResults
+    TrackingSerializer, BatchSerializer, BatchSequenceSerializer, BatchTrackedResultsSerializer,\
+    BatchTrackingSerializer
+from tracking.tasks import profile_and_track, profile_and_track_batch
+from tracking.models import Sequence, TrackedResults, Batch, BatchSequence, BatchTrackedResults
 
 
 class SequenceList(generics.ListCreateAPIView):
@@ -79,3 +80,54 @@ class Tracking(APIView):
                                     str(serializer.data["profile_db"]))
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class BatchList(generics.ListCreateAPIView):
+    queryset = Batch.objects.all()
+    serializer_class = BatchSerializer
+
+
+class BatchDetail(mixins.RetrieveModelMixin,
+                  mixins.DestroyModelMixin,
+                  generics.GenericAPIView):
+    queryset = Batch.objects.all()
+    serializer_class = BatchSerializer
+
+    def get(self, request, *args, **kwargs):
+        return self.retrieve(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        return self.destroy(request, *args, **kwargs)
+
+
+class BatchSequenceList(generics.ListCreateAPIView):
+    queryset = BatchSequence.objects.all()
+    serializer_class = BatchSequenceSerializer
+
+
+class BatchTrackedResultsList(generics.ListCreateAPIView):
+    queryset = BatchTrackedResults.objects.all()
+    serializer_class = BatchTrackedResultsSerializer
+
+
+class BatchTrackedResultsDetail(mixins.RetrieveModelMixin,
+                                mixins.DestroyModelMixin,
+                                generics.GenericAPIView):
+    queryset = BatchTrackedResults.objects.all()
+    serializer_class = BatchTrackedResultsSerializer
+
+    def get(self, request, *args, **kwargs):
+        return self.retrieve(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        return self.destroy(request, *args, **kwargs)
+
+
+class BatchTracking(APIView):
+    def post(self, request, format=None):
+        serializer = BatchTrackingSerializer(data=request.data)
+        if serializer.is_valid():
+            profile_and_track_batch.delay(str(serializer.data["id"]), str(serializer.data["allele_db"]), 95,
+                                          str(serializer.data["profile_db"]))
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)